@@ -0,0 +1,156 @@
+"""
+Measures what `[p]load palantir` and `[p]reload palantir` cost.
+
+    import   importing the cog's module in a fresh interpreter, on top of Red and discord.py
+             which a running bot has imported already, so only the cog's own share shows
+    load     constructing the cog and running its startup I/O (cog_load short of the scheduled task)
+    reload   what Red does on a reload: the old cog closed, the package dropped from sys.modules,
+             imported again and loaded
+
+Load and reload run against the fake Discord from fakediscord.py. Both also report the longest
+the event loop was held up meanwhile, anything a bot's other cogs would have had to wait for.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --runs 20 --top 20
+
+Needs the same environment as the cog itself (Red, discord.py, pyzandro), but no network access.
+"""
+
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from logging.handlers import QueueListener
+from pathlib import Path
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from bench_palantir import LoopLagMonitor, close_cog, percentile
+from fakediscord import FakeBot, FakeConfig
+
+MARKER = "--- palantir ---"
+
+# what a running bot has imported before it gets to load the cog
+IMPORT_PROBE = f"""
+import sys, time
+import discord, discord.ext.tasks
+import redbot.core.bot, redbot.core.commands, redbot.core.data_manager
+import redbot.core.utils.chat_formatting, redbot.core.utils.menus, redbot.core.utils.predicates
+sys.stderr.write("{MARKER}\\n")
+start = time.perf_counter()
+# what setup() imports, the package itself is next to empty
+import palantir.palantir
+print(time.perf_counter() - start)
+"""
+
+def time_import(importtime = False):
+
+    """Returns the seconds `import palantir.palantir` took in a fresh interpreter and, with `importtime`, the -X importtime lines for it"""
+
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", IMPORT_PROBE]
+    result = subprocess.run(command, cwd = REPO_PATH, capture_output = True, text = True, check = True)
+
+    lines = result.stderr.splitlines()
+    lines = lines[lines.index(MARKER) + 1:] if MARKER in lines else []
+    return float(result.stdout.split()[-1]), lines
+
+def heaviest_imports(lines, top):
+
+    """(own ms, cumulative ms, module) of the slowest modules by their own import time"""
+
+    modules = []
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(own) / 1000, int(cumulative) / 1000, name.strip()))
+
+    return sorted(modules, reverse = True)[:top]
+
+def purge_package():
+    for name in [name for name in sys.modules if name == "palantir" or name.startswith("palantir.")]:
+        del sys.modules[name]
+
+async def load_cog(bot, data_path):
+    cog_module = importlib.import_module("palantir.palantir")
+    cog_module.Config = FakeConfig
+    cog_module.cog_data_path = lambda cog: Path(data_path)
+
+    cog = cog_module.Palantir(bot)
+    await cog.initialize()
+    return cog
+
+async def time_phase(monitor, func):
+    monitor.reset()
+    start = time.perf_counter()
+    result = await func()
+    elapsed = time.perf_counter() - start
+    # let the monitor see the last stretch the loop was held up
+    await asyncio.sleep(monitor.interval * 2)
+    return result, elapsed, monitor.max_lag
+
+def print_phase(name, durations, lags):
+    print(f"{name:<8} {percentile(durations, 0.5) * 1000:>8.1f} {max(durations) * 1000:>8.1f} "
+        f"{(max(lags) * 1000 if lags else 0):>8.1f}")
+
+async def main(args):
+    imports = [time_import()[0] for run in range(args.runs)]
+    _, lines = time_import(importtime = True)
+
+    bot = FakeBot(1)
+    monitor = LoopLagMonitor()
+    loads, load_lags, reloads, reload_lags = [], [], [], []
+
+    with tempfile.TemporaryDirectory() as data_path:
+        # the first load pulls in everything the package imports, the rest only re-run the cog's own code
+        purge_package()
+        cog = await load_cog(bot, data_path)
+        listener = QueueListener(sys.modules["palantir.palantir"].log_queue, logging.NullHandler())
+        listener.start()
+        close_cog(cog)
+
+        monitor.start()
+
+        for run in range(args.runs):
+            cog, elapsed, lag = await time_phase(monitor, lambda: load_cog(bot, data_path))
+            loads.append(elapsed)
+            load_lags.append(lag)
+            close_cog(cog)
+
+        listener.stop()
+
+        for run in range(args.runs):
+            def reload():
+                purge_package()
+                return load_cog(bot, data_path)
+
+            cog, elapsed, lag = await time_phase(monitor, reload)
+            reloads.append(elapsed)
+            reload_lags.append(lag)
+            close_cog(cog)
+
+        monitor.stop()
+
+    print(f"{'phase':<8} {'p50 ms':>8} {'max ms':>8} {'lag ms':>8}")
+    print_phase("import", imports, [])
+    print_phase("load", loads, load_lags)
+    print_phase("reload", reloads, reload_lags)
+
+    print("\nslowest imports under `import palantir.palantir` (-X importtime, one run):")
+    print(f"{'own ms':>8} {'cum ms':>8}  module")
+    for own, cumulative, name in heaviest_imports(lines, args.top):
+        print(f"{own:>8.1f} {cumulative:>8.1f}  {name}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark how long loading and reloading Palantir takes")
+    parser.add_argument("--runs", type = int, default = 10, help = "runs of every phase")
+    parser.add_argument("--top", type = int, default = 15, help = "number of slowest imports to list")
+
+    asyncio.run(main(parser.parse_args()))
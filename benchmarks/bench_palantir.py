@@ -0,0 +1,217 @@
+"""
+Offline benchmark for Palantir's scheduled tick.
+
+Starts a local fake master and game server farm (see fakefarm.py) and a fake Discord layer
+(see fakediscord.py), then runs full ticks of the real sched_task for every combination of
+server and guild counts, reporting tick latency, throughput, event loop blocking and memory.
+
+    python benchmarks/bench_palantir.py
+    python benchmarks/bench_palantir.py --servers 10,100,1000 --guilds 1,50,500 --ticks 10 --loss 0.05
+
+Needs the same environment as the cog itself (Red, discord.py, pyzandro), but no network access.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from logging.handlers import QueueListener
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakediscord import FakeBot, FakeConfig
+from fakefarm import FakeBackend, FakeFarm
+
+import palantir.palantir as cog_module
+from palantir.filters import DEFAULT_FILTER
+from palantir.queryengine import MasterPool
+from palantir.recorder import TickRecorder
+
+class LoopLagMonitor:
+
+    """Measures how late the event loop wakes up a sleeping task, any lag is time something blocked the loop"""
+
+    def __init__(self, interval = 0.005, threshold = 0.005):
+        self.interval = interval
+        self.threshold = threshold
+        self.task = None
+        self.reset()
+
+    def reset(self):
+        self.max_lag = 0
+        self.blocked = 0
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.blocked += lag
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self.task.cancel()
+
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+async def make_cog(farm, bot, args, data_path):
+    cog_module.Config = FakeConfig
+    cog_module.cog_data_path = lambda cog: Path(data_path)
+
+    cog = cog_module.Palantir(bot)
+    # what cog_load does, short of starting the scheduled task and the endpoints
+    await cog.initialize()
+
+    # without a farm the cog never queries anything, as when replaying a recording
+    if farm is not None:
+        pipeline = cog.pipeline
+        pipeline.query_engine.backend = FakeBackend(timeout = args.timeout)
+        pipeline.query_engine.timeout = args.timeout
+        pipeline.tick_deadline = args.deadline
+        pipeline.master_pool = MasterPool(pipeline.query_engine, [farm.master_address], on_update = pipeline.master_list_updated)
+
+    embed_ids = itertools.count(1)
+    cog.guild_configs = {guild.id: {
+        "channel_id": guild.channel.id,
+        "embed_id": next(embed_ids),
+        "role_to_notify": 0,
+        "bot_config_channel": 0,
+        "filters": DEFAULT_FILTER,
+    } for guild in bot.guilds.values()}
+    cog.rebuild_filter_index()
+
+    return cog
+
+def close_cog(cog):
+    if cog.recorder is not None:
+        cog.recorder.close()
+    cog.pipeline.close()
+    cog.geoip.close()
+    cog.history.close()
+
+async def run_case(num_servers, num_guilds, args):
+    farm = FakeFarm(num_servers, latency = args.latency, jitter = args.jitter, loss = args.loss).start()
+    bot = FakeBot(num_guilds, latency = args.discord_latency)
+    monitor = LoopLagMonitor()
+
+    if args.memory:
+        tracemalloc.start()
+
+    with tempfile.TemporaryDirectory() as data_path:
+        cog = await make_cog(farm, bot, args, data_path)
+        if args.record:
+            cog.recorder = TickRecorder(os.path.abspath(f"{args.record}-{num_servers}-{num_guilds}.jsonl.gz"))
+        monitor.start()
+
+        durations = []
+        for tick in range(args.ticks):
+            # every server and the master are due, as after a restart or with a very short interval
+            cog.pipeline.poll_scheduler.master_due_at = 0
+            cog.pipeline.poll_scheduler.poll_all()
+
+            start = time.perf_counter()
+            await cog.sched_task()
+            durations.append(time.perf_counter() - start)
+
+            farm.shuffle_players(args.churn)
+
+        monitor.stop()
+        close_cog(cog)
+
+    memory = None
+    if args.memory:
+        current, peak = tracemalloc.get_traced_memory()
+        memory = peak / 2 ** 20
+        tracemalloc.stop()
+
+    farm.stop()
+
+    cold, warm = durations[0], durations[1:] or durations
+    return {
+        "servers": num_servers,
+        "guilds": num_guilds,
+        "cold_tick": cold,
+        "p50": percentile(warm, 0.5),
+        "p99": percentile(warm, 0.99),
+        "servers_per_second": num_servers / statistics.mean(warm),
+        "edits": bot.edits(),
+        "edits_skipped": cog.metrics.counters["edits_skipped"],
+        "loop_max_lag": monitor.max_lag,
+        "loop_blocked": monitor.blocked,
+        "peak_memory_mb": memory,
+    }
+
+def print_result(result):
+    memory = f"{result['peak_memory_mb']:8.1f}" if result['peak_memory_mb'] is not None else f"{'-':>8}"
+    print(f"{result['servers']:>7} {result['guilds']:>6} "
+        f"{result['cold_tick'] * 1000:>9.0f} {result['p50'] * 1000:>8.0f} {result['p99'] * 1000:>8.0f} "
+        f"{result['servers_per_second']:>9.0f} {result['edits']:>6} {result['edits_skipped']:>6} "
+        f"{result['loop_max_lag'] * 1000:>8.1f} {result['loop_blocked'] * 1000:>8.1f} {memory}")
+
+def raise_file_limit():
+    # one socket per fake game server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def main(args):
+    raise_file_limit()
+
+    # logging stays on the hot path as in production, it just doesn't end up anywhere
+    listener = QueueListener(cog_module.log_queue, logging.NullHandler())
+    listener.start()
+
+    print(f"{'servers':>7} {'guilds':>6} {'cold ms':>9} {'p50 ms':>8} {'p99 ms':>8} {'srv/s':>9} "
+        f"{'edits':>6} {'skip':>6} {'lag ms':>8} {'block ms':>8} {'mem MB':>8}")
+
+    results = []
+    for num_servers in args.servers:
+        for num_guilds in args.guilds:
+            result = await run_case(num_servers, num_guilds, args)
+            print_result(result)
+            results.append(result)
+
+    listener.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+def int_list(value):
+    return [int(item) for item in value.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark Palantir's scheduled tick against a local fake server farm")
+    parser.add_argument("--servers", type = int_list, default = [10, 100, 1000], help = "comma separated game server counts")
+    parser.add_argument("--guilds", type = int_list, default = [1, 50, 500], help = "comma separated guild counts")
+    parser.add_argument("--ticks", type = int, default = 5, help = "ticks per case, the first one is reported separately as cold")
+    parser.add_argument("--latency", type = float, default = 0.03, help = "game server round trip in seconds")
+    parser.add_argument("--jitter", type = float, default = 0.01, help = "standard deviation of the round trip")
+    parser.add_argument("--loss", type = float, default = 0.0, help = "fraction of queries the game servers drop")
+    parser.add_argument("--timeout", type = float, default = 1.0, help = "query timeout in seconds")
+    parser.add_argument("--deadline", type = float, default = 15.0, help = "tick deadline in seconds, queries still running after it are cut off")
+    parser.add_argument("--churn", type = float, default = 0.2, help = "fraction of servers whose players change between ticks")
+    parser.add_argument("--discord-latency", type = float, default = 0.05, help = "latency of a fake Discord request in seconds")
+    parser.add_argument("--no-memory", dest = "memory", action = "store_false", help = "skip tracemalloc, it slows the ticks down")
+    parser.add_argument("--json", help = "also write the results to this file")
+    parser.add_argument("--record", metavar = "PREFIX", help = "record every case's ticks to PREFIX-<servers>-<guilds>.jsonl.gz, see replay_palantir.py")
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,115 @@
+"""
+Just enough of discord.py and Red for Palantir to run a tick without a Discord connection.
+"""
+
+import asyncio
+import itertools
+
+_ids = itertools.count(1000)
+
+class FakeMessage:
+
+    def __init__(self, channel, message_id, latency):
+        self.channel = channel
+        self.id = message_id
+        self.latency = latency
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.channel.edits += 1
+        return self
+
+    async def delete(self):
+        pass
+
+
+
+class FakeChannel:
+
+    def __init__(self, guild, latency):
+        self.id = next(_ids)
+        self.guild = guild
+        self.latency = latency
+        self.mention = f"<#{self.id}>"
+        self.edits = 0
+        self.sent = 0
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self, message_id, self.latency)
+
+    async def send(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return FakeMessage(self, next(_ids), self.latency)
+
+
+
+class FakeGuild:
+
+    def __init__(self, latency):
+        self.id = next(_ids)
+        self.name = f"Fake guild {self.id}"
+        self.channel = FakeChannel(self, latency)
+
+    def get_role(self, role_id):
+        return None
+
+
+
+class FakeBot:
+
+    def __init__(self, num_guilds, latency = 0.05):
+        self.guilds = {}
+        self.channels = {}
+
+        for _ in range(num_guilds):
+            guild = FakeGuild(latency)
+            self.guilds[guild.id] = guild
+            self.channels[guild.channel.id] = guild.channel
+
+    def get_guild(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def wait_until_red_ready(self):
+        pass
+
+    async def change_presence(self, **kwargs):
+        pass
+
+    def edits(self) -> int:
+        return sum(channel.edits for channel in self.channels.values())
+
+
+
+class FakeGroup:
+
+    async def set_raw(self, *path, value):
+        pass
+
+    async def clear(self):
+        pass
+
+
+
+class FakeConfig:
+
+    """Stands in for Red's Config, Palantir only touches it to load and store guild settings"""
+
+    def __init__(self):
+        self.guilds = {}
+
+    @classmethod
+    def get_conf(cls, cog, identifier):
+        return cls()
+
+    def register_guild(self, **defaults):
+        self.defaults = defaults
+
+    async def all_guilds(self):
+        return self.guilds
+
+    def guild_from_id(self, guild_id):
+        return FakeGroup()
@@ -0,0 +1,161 @@
+"""
+Local UDP stand-ins for a Zandronum master server and a farm of game servers.
+
+The stand-ins don't speak the real launcher protocol (pyzandro keeps its Huffman codec to itself),
+requests and replies are plain JSON datagrams. Everything around it is real though: one UDP socket
+per server, blocking queries from Palantir's worker pool, latency, jitter and packet loss.
+"""
+
+import asyncio
+import json
+import random
+import socket
+import threading
+
+WADS = ["qcdev-v3.0.pk3", "qcde-maps.pk3", "brutalv21.pk3", "ctf-maps.wad", "zdoom-duel.pk3"]
+MAPS = ["QCDM01", "QCDM02", "MAP01", "E1M1", "CTF03"]
+NAMES = ["Ranger", "Doomguy", "Sorlag", "Wrack", "Korax", "Blazkowicz", "Caleb", "Galena"]
+
+class FakeGameServer(asyncio.DatagramProtocol):
+
+    def __init__(self, farm, info):
+        self.farm = farm
+        self.info = info
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if random.random() < self.farm.loss:
+            return
+
+        delay = max(0, random.gauss(self.farm.latency, self.farm.jitter))
+        asyncio.get_running_loop().call_later(delay, self.transport.sendto, json.dumps(self.info).encode(), addr)
+
+
+
+class FakeMaster(asyncio.DatagramProtocol):
+
+    def __init__(self, farm):
+        self.farm = farm
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        delay = max(0, random.gauss(self.farm.latency, self.farm.jitter))
+        asyncio.get_running_loop().call_later(delay, self.transport.sendto, json.dumps(self.farm.addresses).encode(), addr)
+
+
+
+class FakeFarm:
+
+    """
+    Runs the master and `num_servers` game servers on their own event loop in a background thread,
+    so they don't add to the event loop lag measured on the benchmark's loop.
+    """
+
+    def __init__(self, num_servers, latency = 0.03, jitter = 0.01, loss = 0.0, match_ratio = 0.3, max_players = 16, seed = 0):
+        self.num_servers = num_servers
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.match_ratio = match_ratio
+        self.max_players = max_players
+        self.random = random.Random(seed)
+
+        self.addresses = []
+        self.master_address = None
+        self.servers = []
+
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+
+    def make_info(self, index, wads = None):
+        num_players = self.random.randrange(self.max_players + 1) if self.random.random() < 0.5 else 0
+        players = [{"name_nocolor": f"{self.random.choice(NAMES)}{n}", "bot": int(self.random.random() < 0.3)} for n in range(num_players)]
+        if wads is None:
+            wads = ["qcdev-v3.0.pk3"] if self.random.random() < self.match_ratio else [self.random.choice(WADS[2:])]
+
+        return {
+            "name_nocolor": f"Fake server #{index}",
+            "mapname": self.random.choice(MAPS),
+            "num_players": num_players,
+            "players": players,
+            "gametype": self.random.randrange(16),
+            "iwad": "doom2.wad",
+            "pwads": wads,
+            "forcepassword": self.random.random() < 0.1,
+            "forcejoinpassword": False,
+        }
+
+    async def _start(self):
+        loop = asyncio.get_running_loop()
+
+        for index in range(self.num_servers):
+            server = FakeGameServer(self, self.make_info(index))
+            transport, _ = await loop.create_datagram_endpoint(lambda: server, local_addr = ("127.0.0.1", 0))
+            host, port = transport.get_extra_info("sockname")
+            self.servers.append(server)
+            self.addresses.append(f"{host}:{port}")
+
+        transport, _ = await loop.create_datagram_endpoint(lambda: FakeMaster(self), local_addr = ("127.0.0.1", 0))
+        host, port = transport.get_extra_info("sockname")
+        self.master_address = f"{host}:{port}"
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self._start())
+        self.ready.set()
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread = threading.Thread(target = self._run, name = "fake-farm", daemon = True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def shuffle_players(self, ratio = 0.2):
+
+        """Change the player lists of some servers, so consecutive ticks have something to render"""
+
+        def shuffle():
+            for server in self.random.sample(self.servers, int(len(self.servers) * ratio)):
+                server.info = self.make_info(self.servers.index(server), wads = server.info["pwads"])
+
+        self.loop.call_soon_threadsafe(shuffle)
+
+
+
+class FakeBackend:
+
+    """Stands in for the pyzandro module in Palantir's QueryEngine"""
+
+    def __init__(self, timeout = 2.0):
+        self.timeout = timeout
+
+    def _request(self, address):
+        host, port = address.rsplit(":", 1)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.sendto(b"{}", (host, int(port)))
+            try:
+                data, _ = sock.recvfrom(65535)
+            except socket.timeout:
+                raise TimeoutError(f"{address} did not answer")
+        return json.loads(data)
+
+    def query_master(self, address):
+        return self._request(address)
+
+    def query_server(self, address, flags = None):
+        server_info = self._request(address)
+        server_info["pwads"] = [wad.encode() for wad in server_info["pwads"]]
+        return server_info
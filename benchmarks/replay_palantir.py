@@ -0,0 +1,76 @@
+"""
+Replays a tick recording through Palantir's activity check, embed rendering and embed edits.
+
+Recordings come from `[p]palantir debug record` on a live bot, or from bench_palantir.py --record.
+Nothing is queried, the Discord side is the fake from fakediscord.py. Useful to reproduce what a bot
+did during an incident, or to measure rendering and diffing on weeks of real traffic in seconds.
+
+    python benchmarks/replay_palantir.py ticks-20240101-120000.jsonl.gz
+    python benchmarks/replay_palantir.py ticks-20240101-120000.jsonl.gz --speed 1 --guilds 50
+
+Needs the same environment as the cog itself (Red, discord.py, pyzandro), but no network access.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from logging.handlers import QueueListener
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_palantir import close_cog, make_cog, percentile
+from fakediscord import FakeBot
+
+import palantir.palantir as cog_module
+from palantir.recorder import read_recording, replay_recording
+
+async def main(args):
+    listener = QueueListener(cog_module.log_queue, logging.NullHandler())
+    listener.start()
+
+    bot = FakeBot(args.guilds, latency = args.discord_latency)
+    durations = []
+    servers = 0
+
+    def on_tick(record, seconds):
+        nonlocal servers
+        durations.append(seconds)
+        servers += len(record["servers"])
+        if args.verbose:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(record['ts']))}  polled {len(record['polled']):>5}  "
+                f"answered {len(record['servers']):>5}  cut off {len(record['cut_off']):>4}  publish {seconds * 1000:>8.1f} ms")
+
+    with tempfile.TemporaryDirectory() as data_path:
+        cog = await make_cog(None, bot, args, data_path)
+
+        start = time.perf_counter()
+        await replay_recording(cog, read_recording(args.recording), speed = args.speed or None, on_tick = on_tick)
+        elapsed = time.perf_counter() - start
+
+        close_cog(cog)
+
+    listener.stop()
+
+    if len(durations) == 0:
+        print("The recording has no ticks.")
+        return
+
+    print(f"ticks: {len(durations)}, server snapshots: {servers}, wall time: {elapsed:.2f}s")
+    print(f"publish p50: {percentile(durations, 0.5) * 1000:.1f} ms, p99: {percentile(durations, 0.99) * 1000:.1f} ms, "
+        f"max: {max(durations) * 1000:.1f} ms")
+    print(f"snapshots/s: {servers / sum(durations):.0f}, embed edits: {bot.edits()}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Replay a Palantir tick recording against a fake Discord")
+    parser.add_argument("recording", help = "a .jsonl or .jsonl.gz recording")
+    parser.add_argument("--speed", type = float, default = 0, help = "1 replays at the recorded pace, 0 as fast as possible")
+    parser.add_argument("--guilds", type = int, default = 1, help = "number of fake guilds with an embed")
+    parser.add_argument("--discord-latency", type = float, default = 0.0, help = "latency of a fake Discord request in seconds")
+    parser.add_argument("--verbose", "-v", action = "store_true", help = "print every tick")
+
+    asyncio.run(main(parser.parse_args()))
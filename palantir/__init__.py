@@ -1,4 +1,4 @@
-from .palantir import Palantir
-
 async def setup(bot):
+    # imported here so `python -m palantir.scanner` runs without Red and discord.py installed
+    from .palantir import Palantir
     await bot.add_cog(Palantir(bot))
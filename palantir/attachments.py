@@ -0,0 +1,60 @@
+"""
+Builders for the files the admin commands upload. They read, format and compress on whatever thread
+they are called from, the commands run them in an executor so the event loop never waits on the disk.
+Each returns a list of (filename, bytes) parts that each fit the upload limit.
+"""
+
+import gzip
+import io
+import os
+import pprint
+import zipfile
+
+DEFAULT_UPLOAD_LIMIT = 25 * 1024 * 1024
+
+# leaves room for the rest of the multipart request
+UPLOAD_MARGIN = 64 * 1024
+
+def split_payload(filename, data, limit) -> list:
+
+    """Cuts `data` into numbered parts, `cat name.001 name.002 ... > name` puts them back together"""
+
+    if len(data) <= limit:
+        return [(filename, data)]
+
+    return [(f"{filename}.{number:03d}", data[offset:offset + limit])
+        for number, offset in enumerate(range(0, len(data), limit), start = 1)]
+
+def log_file_payload(path, limit) -> list:
+    with open(path, "rb") as f:
+        data = f.read()
+
+    filename = os.path.basename(path)
+    if len(data) > limit:
+        data = gzip.compress(data, compresslevel = 9)
+        filename += ".gz"
+
+    return split_payload(filename, data, limit)
+
+def zip_directory(path, compression, compresslevel = None) -> bytes:
+    buffer = io.BytesIO()
+
+    with zipfile.ZipFile(buffer, "w", compression = compression, compresslevel = compresslevel) as archive:
+        for name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, name)
+            if os.path.isfile(file_path):
+                archive.write(file_path, name)
+
+    return buffer.getvalue()
+
+def log_archive_payload(path, filename, limit) -> list:
+    data = zip_directory(path, zipfile.ZIP_DEFLATED, compresslevel = 6)
+
+    if len(data) > limit:
+        # log files shrink a good deal more with LZMA, which every current unzip tool reads
+        data = zip_directory(path, zipfile.ZIP_LZMA)
+
+    return split_payload(filename, data, limit)
+
+def server_dump_payload(servers, filename, limit) -> list:
+    return split_payload(filename, pprint.pformat(servers).encode(), limit)
@@ -0,0 +1,222 @@
+import asyncio
+import time
+
+from collections import Counter, deque
+
+DEFAULT_QUEUE_SIZE = 1000
+
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+
+class ServerEvent:
+
+    """
+    Something that changed on a game server between two consecutive snapshots.
+    `server` is the snapshot the change was seen in, for ServerDown the last one known.
+    """
+
+    __slots__ = ("address", "server", "time")
+
+    def __init__(self, server, timestamp = None):
+        self.address = server.address
+        self.server = server
+        self.time = timestamp or time.time()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.address!r})"
+
+class ServerUp(ServerEvent):
+    """A server started showing up in Palantir's list"""
+    __slots__ = ()
+
+class ServerDown(ServerEvent):
+    """A server stopped answering, left the master list or no longer matches any guild filter"""
+    __slots__ = ()
+
+class PlayerEvent(ServerEvent):
+    __slots__ = ("player",)
+
+    def __init__(self, server, player, timestamp = None):
+        super().__init__(server, timestamp)
+        self.player = player
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.address!r}, {self.player.name!r})"
+
+class PlayerJoined(PlayerEvent):
+    __slots__ = ()
+
+class PlayerLeft(PlayerEvent):
+    __slots__ = ()
+
+class MapChanged(ServerEvent):
+    __slots__ = ("previous",)
+
+    def __init__(self, server, previous, timestamp = None):
+        super().__init__(server, timestamp)
+        self.previous = previous
+
+    def __repr__(self):
+        return f"MapChanged({self.address!r}, {self.previous!r} -> {self.server.mapname!r})"
+
+class LockChanged(ServerEvent):
+    __slots__ = ("locked",)
+
+    def __init__(self, server, timestamp = None):
+        super().__init__(server, timestamp)
+        self.locked = server.locked
+
+def diff_snapshots(old, new, timestamp = None) -> list:
+
+    """Returns the events that lead from snapshot `old` to `new`, either may be None"""
+
+    timestamp = timestamp or time.time()
+
+    if old is None and new is None:
+        return []
+    if old is None:
+        return [ServerUp(new, timestamp)]
+    if new is None:
+        return [ServerDown(old, timestamp)]
+
+    # nothing visible changed, which is the case for most servers on most polls
+    if old.fingerprint == new.fingerprint:
+        return []
+
+    events = []
+
+    if old.mapname != new.mapname:
+        events.append(MapChanged(new, old.mapname, timestamp))
+
+    if old.locked != new.locked:
+        events.append(LockChanged(new, timestamp))
+
+    # players are told apart by name and whether they are a bot, the same name twice counts twice
+    old_players = Counter((player.name, player.is_bot) for player in old.players)
+    new_players = Counter((player.name, player.is_bot) for player in new.players)
+    players = {(player.name, player.is_bot): player for player in old.players + new.players}
+
+    for key, count in (old_players - new_players).items():
+        events += [PlayerLeft(new, players[key], timestamp) for _ in range(count)]
+    for key, count in (new_players - old_players).items():
+        events += [PlayerJoined(new, players[key], timestamp) for _ in range(count)]
+
+    return events
+
+
+
+class Subscription:
+
+    """
+    A subscriber's bounded queue of events, iterate over it to receive them:
+
+        async for event in palantir.events.subscribe(PlayerJoined, PlayerLeft):
+            ...
+
+    When the queue is full, the oldest queued event is dropped (or the new one, with `drop = DROP_NEWEST`),
+    publishing never waits for a subscriber. `dropped` counts what a slow subscriber missed.
+    """
+
+    def __init__(self, bus, event_types = (), maxsize = DEFAULT_QUEUE_SIZE, drop = DROP_OLDEST):
+        self.bus = bus
+        self.event_types = tuple(event_types) or (ServerEvent,)
+        self.maxsize = maxsize
+        self.drop = drop
+
+        self.queue = deque()
+        self.waiter = None
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, event):
+        if self.closed or not isinstance(event, self.event_types):
+            return
+
+        if len(self.queue) >= self.maxsize:
+            self.dropped += 1
+            if self.drop == DROP_NEWEST:
+                return
+            self.queue.popleft()
+
+        self.queue.append(event)
+        self._wake()
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self) -> ServerEvent:
+
+        """Waits for the next event, raises StopAsyncIteration once the subscription is closed"""
+
+        while len(self.queue) == 0:
+            if self.closed:
+                raise StopAsyncIteration
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+
+        return self.queue.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ServerEvent:
+        return await self.get()
+
+    def close(self):
+        self.closed = True
+        self.bus.subscriptions.discard(self)
+        self._wake()
+
+
+
+class EventBus:
+
+    """
+    Hands the events Palantir sees to any number of subscribers, each with its own bounded queue.
+
+    subscribe() returns an async iterator, add_listener() calls a function (plain or coroutine) for every event
+    from a task of its own. Either way a slow consumer only ever loses its own events and never holds up a scan.
+    """
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.listener_tasks = set()
+
+    def subscribe(self, *event_types, maxsize = DEFAULT_QUEUE_SIZE, drop = DROP_OLDEST) -> Subscription:
+        subscription = Subscription(self, event_types, maxsize = maxsize, drop = drop)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def add_listener(self, callback, *event_types, maxsize = DEFAULT_QUEUE_SIZE, drop = DROP_OLDEST) -> Subscription:
+
+        """Call `callback(event)` for every event, close the returned subscription to stop"""
+
+        subscription = self.subscribe(*event_types, maxsize = maxsize, drop = drop)
+
+        async def listen():
+            async for event in subscription:
+                try:
+                    result = callback(event)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    # the listener keeps going, one bad event shouldn't unsubscribe anyone
+                    asyncio.get_running_loop().call_exception_handler({
+                        "message": f"Exception in Palantir event listener {callback!r}",
+                        "exception": e,
+                    })
+
+        task = asyncio.ensure_future(listen())
+        self.listener_tasks.add(task)
+        task.add_done_callback(self.listener_tasks.discard)
+        return subscription
+
+    def publish(self, events):
+        for event in events:
+            for subscription in list(self.subscriptions):
+                subscription.put(event)
+
+    def close(self):
+        for subscription in list(self.subscriptions):
+            subscription.close()
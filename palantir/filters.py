@@ -0,0 +1,232 @@
+import json
+import re
+
+CATEGORIES = ("pwads", "iwads", "gametypes", "names")
+REGEX_PREFIX = "re:"
+
+# server names come from whoever hosts the server, a regular expression only ever sees this much of them
+MAX_REGEX_LENGTH = 200
+MAX_MATCH_LENGTH = 256
+
+# one unbounded repeat and a few short optional parts, anything beyond can take seconds on a hostile name
+MAX_MATCH_COST = MAX_MATCH_LENGTH * 4
+
+QUANTIFIER = re.compile(r"\{(\d*)(,?)(\d*)\}")
+
+DEFAULT_FILTER = {
+    "pwads": ["qcdev"],
+    "iwads": [],
+    "gametypes": [],
+    "names": [],
+    "title": "QC:DE Servers",
+}
+
+class FilterException(Exception):
+    pass
+
+def match_cost(expression) -> int:
+
+    """
+    An upper bound on the number of ways a regular expression can split a string between its repeats,
+    which is what matching costs at worst. A repeat without an upper bound counts as MAX_MATCH_LENGTH ways.
+
+    Repeated groups and backreferences aren't covered by the bound and raise FilterException. The expression
+    is expected to compile already, only as much of the syntax as the bound needs is looked at.
+    """
+
+    # every open group as [ways of its finished alternatives, ways of the current one]
+    groups = [[0, 1]]
+    # what a quantifier here would repeat: "atom", "group" or None where it can't repeat anything
+    previous = None
+    i = 0
+
+    while i < len(expression):
+        char = expression[i]
+        upper, length = None, 1
+        braces = QUANTIFIER.match(expression, i) if char == "{" else None
+
+        if char == "\\":
+            escaped = expression[i + 1:i + 2]
+            if escaped.isdigit() and escaped != "0":
+                raise FilterException("Backreferences can make matching too slow")
+            previous = "atom"
+            i += 2
+            continue
+        elif char == "[":
+            # a set ends at the first ] that isn't its first member
+            i += 1
+            if expression.startswith("^", i):
+                i += 1
+            if expression.startswith("]", i):
+                i += 1
+            while i < len(expression) and expression[i] != "]":
+                i += 2 if expression[i] == "\\" else 1
+            previous = "atom"
+            i += 1
+            continue
+        elif char == "(":
+            if expression.startswith("(?P=", i) or expression.startswith("(?(", i):
+                raise FilterException("Backreferences can make matching too slow")
+            groups.append([0, 1])
+            previous = None
+            i += 1
+            continue
+        elif char == ")":
+            finished, current = groups.pop()
+            groups[-1][1] *= finished + current
+            previous = "group"
+            i += 1
+            continue
+        elif char == "|":
+            groups[-1][0] += groups[-1][1]
+            groups[-1][1] = 1
+            previous = None
+            i += 1
+            continue
+        elif char == "?":
+            upper = 1
+        elif braces is not None and braces.group(1, 3) != ("", ""):
+            low, comma, high = braces.groups()
+            upper = int(high) if high else None if comma else int(low)
+            length = braces.end() - i
+        elif char not in "*+":
+            previous = "atom"
+            i += 1
+            continue
+
+        # the ? after an opening parenthesis, or one that makes the previous quantifier lazy
+        if previous is not None:
+            if previous == "group" and (upper is None or upper > 1):
+                raise FilterException("Repeating a group can make matching too slow")
+            groups[-1][1] *= MAX_MATCH_LENGTH if upper is None else min(upper, MAX_MATCH_LENGTH) + 1
+
+        previous = None
+        i += length
+
+    finished, current = groups[0]
+    return finished + current
+
+def compile_pattern(pattern):
+
+    """
+    Patterns are case-insensitive substrings, or regular expressions when prefixed with 're:'.
+    Returns a function that tells whether a string matches.
+
+    Regular expressions run on the event loop against names anyone hosting a server picks,
+    so ones whose matching could take more than a few milliseconds are refused.
+    """
+
+    if pattern.startswith(REGEX_PREFIX):
+        expression = pattern[len(REGEX_PREFIX):]
+        if len(expression) > MAX_REGEX_LENGTH:
+            raise FilterException(f"Regular expressions can be at most {MAX_REGEX_LENGTH} characters long")
+
+        try:
+            regex = re.compile(expression, re.IGNORECASE)
+        except re.error as e:
+            raise FilterException(f"Invalid regular expression `{pattern}`: {e}")
+
+        try:
+            cost = match_cost(expression)
+        except FilterException as e:
+            raise FilterException(f"`{pattern}`: {e}. Use a simpler expression.")
+
+        if cost > MAX_MATCH_COST:
+            raise FilterException(f"`{pattern}` has too many repeats to match quickly. Use at most one `*`, `+` or `{{n,}}`, "
+                "matching is a search so a leading or trailing `.*` isn't needed.")
+
+        return lambda value: regex.search(value[:MAX_MATCH_LENGTH]) is not None
+
+    needle = pattern.lower()
+    return lambda value: needle in value.lower()
+
+def compile_or_never(pattern):
+    # stored filters may predate a rule compile_pattern enforces now, such patterns just never match
+    try:
+        return compile_pattern(pattern)
+    except FilterException:
+        return lambda value: False
+
+def filter_key(guild_filter) -> str:
+    # guilds with the same rules share one key, and with it one classification and one rendered embed
+    return json.dumps({category: sorted(set(guild_filter.get(category, []))) for category in CATEGORIES}, sort_keys = True)
+
+
+
+class FilterIndex:
+
+    """
+    All guilds' filters compiled into one structure.
+
+    Every distinct pattern is evaluated once per server and recorded as a bit, each distinct filter
+    is then a handful of mask checks. A server is classified once no matter how many guilds there are,
+    the cost only grows with the number of distinct patterns.
+
+    A server matches a filter when, for every category the filter uses, at least one of its patterns matches.
+    """
+
+    def __init__(self, guild_filters: dict):
+        self.guild_filters = {}
+        self.guilds_by_filter = {}
+
+        self.patterns = {category: [] for category in CATEGORIES}
+        self.filters = {}
+
+        pattern_bits = {}
+
+        for guild_id, guild_filter in guild_filters.items():
+            key = filter_key(guild_filter)
+            self.guild_filters[guild_id] = key
+            self.guilds_by_filter.setdefault(key, set()).add(guild_id)
+
+            if key in self.filters:
+                continue
+
+            masks = []
+            for category in CATEGORIES:
+                mask = 0
+                for pattern in sorted(set(guild_filter.get(category, []))):
+                    bit = pattern_bits.get((category, pattern))
+                    if bit is None:
+                        bit = len(pattern_bits)
+                        pattern_bits[(category, pattern)] = bit
+                        self.patterns[category].append((compile_or_never(pattern), 1 << bit))
+                    mask |= 1 << bit
+                if mask != 0:
+                    masks.append(mask)
+
+            self.filters[key] = masks
+
+    def categories(self) -> set:
+
+        """The categories at least one filter looks at"""
+
+        return {category for category, patterns in self.patterns.items() if len(patterns) > 0}
+
+    def classify(self, name = "", iwad = "", gametype = "", wads = ()) -> frozenset:
+
+        """Returns the keys of all filters the server matches"""
+
+        values = {
+            "pwads": wads,
+            "iwads": (iwad or "",),
+            "gametypes": (gametype or "",),
+            "names": (name or "",),
+        }
+
+        matched = 0
+        for category, patterns in self.patterns.items():
+            for matcher, bit in patterns:
+                if any(matcher(value) for value in values[category]):
+                    matched |= bit
+
+        return frozenset(key for key, masks in self.filters.items() if all(matched & mask for mask in masks))
+
+    def classify_snapshot(self, server) -> frozenset:
+        return self.classify(name = server.name, iwad = server.iwad, gametype = server.gametype, wads = server.wads)
+
+    def guilds(self, filter_keys) -> set:
+        guilds = set()
+        for key in filter_keys:
+            guilds |= self.guilds_by_filter.get(key, set())
+        return guilds
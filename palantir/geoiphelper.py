@@ -1,9 +1,13 @@
-import maxminddb
+import asyncio
 import os
+import time
+
+from collections import OrderedDict
 
 # cron job:
 # update GeoLite2-Country.mmdb on every Monday 03:33
-# 33 3 * * 1 bash -c 'mkdir -p ~/.geoip/ && curl -L https://github.com/P3TERX/GeoLite.mmdb/raw/download/GeoLite2-Country.mmdb > ~/.geoip/GeoLite2-Country.mmdb'
+# the file is downloaded next to the old one and moved in place, so a memory-mapped reader never sees a half written database
+# 33 3 * * 1 bash -c 'mkdir -p ~/.geoip/ && curl -L https://github.com/P3TERX/GeoLite.mmdb/raw/download/GeoLite2-Country.mmdb -o ~/.geoip/GeoLite2-Country.mmdb.tmp && mv ~/.geoip/GeoLite2-Country.mmdb.tmp ~/.geoip/GeoLite2-Country.mmdb'
 
 class GeoIpHelperException(Exception):
     pass
@@ -27,7 +31,122 @@ def find_country_mmdb():
             return fullpath
     raise GeoIpHelperException(f"Could not find {filename} at: {SEARCH_PATHS}")
 
-def query_geoip(ip):
-    geoip_filename = find_country_mmdb()
-    with maxminddb.open_database(geoip_filename) as db:
-        return db.get(ip)["country"]["iso_code"]
+
+
+class GeoIpResolver:
+
+    """
+    Long-lived GeoIP lookup.
+
+    The database is opened once in MODE_MMAP and only reopened when the file's mtime changes,
+    which is checked at most every `check_interval` seconds. Resolved addresses are kept in a
+    bounded LRU cache, so repeated lookups are a dict hit. Anything touching the disk runs in
+    the default executor.
+    """
+
+    def __init__(self, cache_size = 4096, check_interval = 300):
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+
+        self.cache = OrderedDict()
+        self.reader = None
+        self.path = None
+        self.mtime = None
+        self.next_check = 0
+
+        self.lock = asyncio.Lock()
+
+    def _refresh(self) -> bool:
+
+        """Open or reopen the database if needed. Returns True if a new database was loaded."""
+
+        # imported on first use, it's a good part of the cog's import time otherwise
+        import maxminddb
+
+        try:
+            path = find_country_mmdb()
+            mtime = os.stat(path).st_mtime
+
+            if self.reader is not None and path == self.path and mtime == self.mtime:
+                return False
+
+            reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+        except GeoIpHelperException:
+            self._close_reader()
+            raise
+        except (OSError, maxminddb.InvalidDatabaseError) as e:
+            self._close_reader()
+            raise GeoIpHelperException(f"Could not open GeoIP database: {e}")
+
+        self._close_reader()
+        self.reader, self.path, self.mtime = reader, path, mtime
+        return True
+
+    def _lookup(self, ip, refresh: bool):
+        reloaded = False
+        if refresh or self.reader is None:
+            reloaded = self._refresh()
+
+        record = self.reader.get(ip)
+
+        try:
+            return record["country"]["iso_code"], reloaded
+        except (KeyError, TypeError):
+            return None, reloaded
+
+    def _close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.reader, self.path, self.mtime = None, None, None
+
+    async def open(self):
+
+        """Opens the database ahead of the first lookup. Returns False if it isn't available, lookups fail until the next check then."""
+
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self._refresh)
+            except GeoIpHelperException:
+                pass
+            finally:
+                self.next_check = time.monotonic() + self.check_interval
+
+        return self.reader is not None
+
+    async def resolve(self, ip) -> str:
+
+        """Returns the ISO country code of an IP address, raises GeoIpHelperException if it can't be resolved."""
+
+        refresh = time.monotonic() >= self.next_check
+
+        if not refresh and self.reader is None:
+            raise GeoIpHelperException("GeoIP database is not available")
+
+        if not refresh and ip in self.cache:
+            self.cache.move_to_end(ip)
+            iso_code = self.cache[ip]
+        else:
+            async with self.lock:
+                loop = asyncio.get_running_loop()
+                try:
+                    iso_code, reloaded = await loop.run_in_executor(None, self._lookup, ip, refresh)
+                finally:
+                    if refresh:
+                        self.next_check = time.monotonic() + self.check_interval
+
+            if reloaded:
+                self.cache.clear()
+
+            self.cache[ip] = iso_code
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last = False)
+
+        if iso_code is None:
+            raise GeoIpHelperException(f"No country record for {ip}")
+
+        return iso_code
+
+    def close(self):
+        self._close_reader()
+        self.cache.clear()
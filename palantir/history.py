@@ -0,0 +1,167 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_RETENTION_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    ts INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    humans INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+
+CREATE TABLE IF NOT EXISTS hourly (
+    hour INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    samples INTEGER NOT NULL,
+    player_sum INTEGER NOT NULL,
+    peak INTEGER NOT NULL,
+    active_samples INTEGER NOT NULL,
+    PRIMARY KEY (hour, address)
+);
+CREATE INDEX IF NOT EXISTS hourly_address ON hourly (address, hour);
+
+CREATE TABLE IF NOT EXISTS daily_players (
+    day INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (day, name)
+);
+
+CREATE TABLE IF NOT EXISTS servers (
+    address TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    last_seen INTEGER NOT NULL
+);
+"""
+
+class HistoryStore:
+
+    """
+    Player count history in SQLite.
+
+    Samples are buffered in memory and written in one transaction per flush. Every write also
+    updates the hourly rollup and the per day set of player names, so the stats queries only ever
+    read small pre-aggregated tables. Raw samples, hourly rollups and player names older than
+    `retention_days` are dropped.
+
+    The connection is owned by a single worker thread, nothing here touches the disk from the event loop.
+    """
+
+    def __init__(self, path, retention_days = DEFAULT_RETENTION_DAYS):
+        self.path = str(path)
+        self.retention_days = retention_days
+
+        self.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "palantir-history")
+        self.connection = None
+        self.buffer = []
+        self.next_prune = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _open(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread = False)
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    async def open(self):
+        await self._run(self._open)
+
+    def record(self, servers, ts = None):
+
+        """Buffer one sample of every server in `servers`"""
+
+        ts = int(ts or time.time())
+        for server in servers:
+            self.buffer.append((ts, server.address, server.name, server.humans,
+                tuple(player.name for player in server.players if not player.is_bot)))
+
+    def _write(self, samples):
+        with self.connection:
+            self.connection.executemany("INSERT INTO samples (ts, address, humans) VALUES (?, ?, ?)",
+                [(ts, address, humans) for ts, address, name, humans, players in samples])
+
+            self.connection.executemany("""
+                INSERT INTO hourly (hour, address, samples, player_sum, peak, active_samples) VALUES (?, ?, 1, ?, ?, ?)
+                ON CONFLICT (hour, address) DO UPDATE SET
+                    samples = samples + 1,
+                    player_sum = player_sum + excluded.player_sum,
+                    peak = MAX(peak, excluded.peak),
+                    active_samples = active_samples + excluded.active_samples
+                """, [(ts - ts % 3600, address, humans, humans, 1 if humans > 0 else 0) for ts, address, name, humans, players in samples])
+
+            self.connection.executemany("INSERT OR IGNORE INTO daily_players (day, name) VALUES (?, ?)",
+                [(ts - ts % 86400, player) for ts, address, name, humans, players in samples for player in players])
+
+            self.connection.executemany("INSERT OR REPLACE INTO servers (address, name, last_seen) VALUES (?, ?, ?)",
+                [(address, name, ts) for ts, address, name, humans, players in samples])
+
+            now = time.time()
+            if now >= self.next_prune:
+                cutoff = int(now) - self.retention_days * 86400
+                self.connection.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+                self.connection.execute("DELETE FROM hourly WHERE hour < ?", (cutoff - cutoff % 3600,))
+                self.connection.execute("DELETE FROM daily_players WHERE day < ?", (cutoff - cutoff % 86400,))
+                self.connection.execute("DELETE FROM servers WHERE last_seen < ?", (cutoff,))
+                self.next_prune = now + 3600
+
+    async def flush(self):
+        samples, self.buffer = self.buffer, []
+        if self.connection is None or len(samples) == 0:
+            return
+
+        await self._run(self._write, samples)
+
+    def _query(self, sql, params):
+        if self.connection is None:
+            return []
+        return self.connection.execute(sql, params).fetchall()
+
+    async def peak_hours(self, days) -> list:
+
+        """Returns (hour of day in UTC, average players, highest players) tuples, busiest first"""
+
+        since = int(time.time()) - days * 86400
+        return await self._run(self._query, """
+            SELECT (hour / 3600) % 24 AS hour_of_day, AVG(total), MAX(total) FROM (
+                SELECT hour, SUM(peak) AS total FROM hourly WHERE hour >= ? GROUP BY hour
+            ) GROUP BY hour_of_day ORDER BY AVG(total) DESC
+            """, (since - since % 3600,))
+
+    async def uptime(self, days) -> list:
+
+        """Returns (address, name, hours seen, hours with players, average players while seen) tuples"""
+
+        since = int(time.time()) - days * 86400
+        return await self._run(self._query, """
+            SELECT hourly.address, servers.name, COUNT(*), SUM(active_samples > 0), SUM(player_sum) * 1.0 / SUM(samples)
+            FROM hourly LEFT JOIN servers ON servers.address = hourly.address
+            WHERE hour >= ? GROUP BY hourly.address ORDER BY COUNT(*) DESC
+            """, (since - since % 3600,))
+
+    async def daily_active(self, days) -> list:
+
+        """Returns (day timestamp, distinct players) tuples, newest first"""
+
+        since = int(time.time()) - days * 86400
+        return await self._run(self._query, """
+            SELECT day, COUNT(*) FROM daily_players WHERE day >= ? GROUP BY day ORDER BY day DESC
+            """, (since - since % 86400,))
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close(self):
+        # whatever is still buffered is written before the connection goes away,
+        # this waits for it, so call it from an executor when on the event loop
+        samples, self.buffer = self.buffer, []
+        if self.connection is not None and len(samples) > 0:
+            self.executor.submit(self._write, samples)
+        self.executor.submit(self._close)
+        self.executor.shutdown(wait = True)
@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from aiohttp import web
+
+PHASES = ("master", "scan", "activity", "render", "fanout", "tick")
+RTT_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNTERS = ("queries", "query_timeouts", "query_errors", "query_cut_off", "ticks_skipped", "edits_sent", "edits_skipped", "edits_failed")
+
+DEFAULT_HISTORY = 200
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+
+class Metrics:
+
+    """
+    Timings and counters of the scheduled task, kept in memory.
+
+    Phase durations and event loop lag only keep the last `history` samples. Query round trips
+    go into a fixed bucket histogram and counters only ever go up, like their Prometheus counterparts.
+    """
+
+    def __init__(self, history = DEFAULT_HISTORY):
+        self.phases = {phase: deque(maxlen = history) for phase in PHASES}
+        self.loop_lag = deque(maxlen = history)
+        self.counters = {counter: 0 for counter in COUNTERS}
+
+        self.rtt_buckets = [0] * len(RTT_BUCKETS)
+        self.rtt_count = 0
+        self.rtt_sum = 0
+
+        self.lag_task = None
+
+    @contextmanager
+    def time(self, phase, timings = None):
+        # `timings`, when given, also gets the duration under the phase's name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.record(phase, seconds)
+            if timings is not None:
+                timings[phase] = seconds
+
+    def record(self, phase, seconds):
+        self.phases[phase].append(seconds)
+
+    def count(self, counter, amount = 1):
+        self.counters[counter] += amount
+
+    def observe_rtt(self, seconds):
+        self.rtt_count += 1
+        self.rtt_sum += seconds
+        for index, bound in enumerate(RTT_BUCKETS):
+            if seconds <= bound:
+                self.rtt_buckets[index] += 1
+
+    async def _monitor_loop(self, interval):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(max(0, time.perf_counter() - start - interval))
+
+    def start_loop_monitor(self, interval = 0.5):
+        self.lag_task = asyncio.ensure_future(self._monitor_loop(interval))
+
+    def stop_loop_monitor(self):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+
+    def phase_summary(self) -> dict:
+
+        """phase -> (last, p50, p99, max) in seconds"""
+
+        summary = {}
+        for phase, samples in self.phases.items():
+            if len(samples) > 0:
+                summary[phase] = (samples[-1], percentile(samples, 0.5), percentile(samples, 0.99), max(samples))
+        return summary
+
+    def prometheus(self) -> str:
+        lines = []
+
+        lines.append("# HELP palantir_phase_seconds Duration of the last scheduled task phase")
+        lines.append("# TYPE palantir_phase_seconds gauge")
+        for phase, (last, p50, p99, highest) in self.phase_summary().items():
+            lines.append(f'palantir_phase_seconds{{phase="{phase}"}} {last:.6f}')
+            lines.append(f'palantir_phase_seconds{{phase="{phase}",quantile="0.5"}} {p50:.6f}')
+            lines.append(f'palantir_phase_seconds{{phase="{phase}",quantile="0.99"}} {p99:.6f}')
+
+        for counter, value in self.counters.items():
+            lines.append(f"# TYPE palantir_{counter}_total counter")
+            lines.append(f"palantir_{counter}_total {value}")
+
+        lines.append("# HELP palantir_query_rtt_seconds Round trip of game server queries")
+        lines.append("# TYPE palantir_query_rtt_seconds histogram")
+        for bound, value in zip(RTT_BUCKETS, self.rtt_buckets):
+            lines.append(f'palantir_query_rtt_seconds_bucket{{le="{bound}"}} {value}')
+        lines.append(f'palantir_query_rtt_seconds_bucket{{le="+Inf"}} {self.rtt_count}')
+        lines.append(f"palantir_query_rtt_seconds_sum {self.rtt_sum:.6f}")
+        lines.append(f"palantir_query_rtt_seconds_count {self.rtt_count}")
+
+        if len(self.loop_lag) > 0:
+            lines.append("# TYPE palantir_event_loop_lag_seconds gauge")
+            lines.append(f"palantir_event_loop_lag_seconds {self.loop_lag[-1]:.6f}")
+            lines.append(f'palantir_event_loop_lag_seconds{{quantile="0.99"}} {percentile(self.loop_lag, 0.99):.6f}')
+
+        return "\n".join(lines) + "\n"
+
+
+
+class MetricsServer:
+
+    """Serves Metrics.prometheus() on http://host:port/metrics"""
+
+    def __init__(self, metrics: Metrics, host, port):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle_metrics(self, request):
+        return web.Response(text = self.metrics.prometheus(), content_type = "text/plain", charset = "utf-8")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+
+        self.runner = web.AppRunner(app, access_log = None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
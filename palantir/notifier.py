@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+DEFAULT_HYSTERESIS = 300
+DEFAULT_SEND_CONCURRENCY = 16
+DEFAULT_SEND_RATE = 40
+
+class ActivityTracker:
+
+    """
+    Decides which guild filters have just become active, debounced per server.
+
+    A server stays active for `hysteresis` seconds after it was last seen with players on it,
+    so a server flapping between empty and populated only ever causes the first notification.
+    A filter is active while any of its servers is, and is reported once when that starts.
+
+    The filters a server matched are kept with the time it was last populated, so a server that misses
+    a poll or two, and is dropped from the cog's state meanwhile, keeps its filters active until the hysteresis runs out.
+    """
+
+    def __init__(self, hysteresis = DEFAULT_HYSTERESIS):
+        self.hysteresis = hysteresis
+        self.last_populated = {}
+        self.active_filters = None
+
+    def seed(self, addresses):
+
+        """Servers that were active before a restart, so they aren't reported as new"""
+
+        now = time.monotonic()
+        for address in addresses:
+            # what they match isn't known until the filters are loaded, active() looks it up meanwhile
+            self.last_populated[address] = (now, None)
+
+    def reset(self):
+        # whatever is active at the next update becomes the baseline, e.g. after the filters changed
+        self.active_filters = None
+
+    def active(self, server_filters) -> set:
+        active = set()
+        for address, (seen, filter_keys) in self.last_populated.items():
+            active |= filter_keys if filter_keys is not None else server_filters.get(address, frozenset())
+        return active
+
+    def update(self, servers, server_filters) -> set:
+
+        """Returns the keys of the filters that have become active since the last update"""
+
+        now = time.monotonic()
+
+        if self.active_filters is None:
+            self.active_filters = self.active(server_filters)
+
+        for server in servers:
+            if server.humans > 0:
+                self.last_populated[server.address] = (now, server_filters.get(server.address, frozenset()))
+
+        self.last_populated = {address: entry for address, entry in self.last_populated.items() if now - entry[0] < self.hysteresis}
+
+        active = self.active(server_filters)
+        started = active - self.active_filters
+        self.active_filters = active
+        return started
+
+
+
+class SendLimiter:
+
+    """
+    Bounds the messages in flight and paces them with a token bucket, so a burst of notifications
+    to many guilds stays under Discord's global rate limit instead of running into 429s.
+
+        async with limiter:
+            await channel.send(...)
+    """
+
+    def __init__(self, concurrency = DEFAULT_SEND_CONCURRENCY, rate = DEFAULT_SEND_RATE):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def _take_token(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            await self._take_token()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
@@ -1,27 +1,37 @@
 import asyncio
+import io
+import json
 import os
-import pprint
 import random
-import shutil
+import sqlite3
 import sys
-import traceback
+import time
 
 from datetime import datetime, timezone
 
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 
 import discord
 from discord.ext import tasks
 from redbot.core import Config, bot, commands
+from redbot.core.data_manager import cog_data_path
+from redbot.core.utils.chat_formatting import box, pagify
 from redbot.core.utils.menus import start_adding_reactions
 from redbot.core.utils.predicates import ReactionPredicate
 
-import pyzandro
-from pyzandro import PyZandroException
-from pyzandro.server import SQF
-
-from .geoiphelper import GeoIpHelperException, query_geoip
+from .events import EventBus, diff_snapshots
+from .geoiphelper import GeoIpHelperException, GeoIpResolver
+from .history import HistoryStore
+from .notifier import DEFAULT_HYSTERESIS, DEFAULT_SEND_CONCURRENCY, DEFAULT_SEND_RATE, ActivityTracker, SendLimiter
+from .metrics import DEFAULT_HISTORY, RTT_BUCKETS, Metrics, MetricsServer, percentile
+from .filters import CATEGORIES, DEFAULT_FILTER, REGEX_PREFIX, FilterException, FilterIndex, compile_pattern
+from .pipeline import ANSWERED, CUT_OFF, STALE, ScanPipeline
+from .statefile import load_state, save_state
+from .statusapi import StatusDocument, StatusServer
+from .scheduler import DEFAULT_RESOLUTION
+from .queryengine import ServerHealth
 
 #TODO: implement notification policies
 #TODO: cleanup
@@ -29,223 +39,690 @@ from .geoiphelper import GeoIpHelperException, query_geoip
 COG_PATH = os.path.dirname(__file__)
 LOGFILE = os.path.join(COG_PATH, "logs/palantir_verbose.log")
 
+GUILD_DEFAULTS = {
+    "channel_id": 0,
+    "embed_id": 0,
+    "role_to_notify": 0,
+    "bot_config_channel": 0,
+    "filters": DEFAULT_FILTER,
+}
+
+# what reload_json picks up, everything else in config.json needs the cog reloaded
+DISPLAY_SETTINGS = ("icon", "thumbnail", "memes")
+
+EDIT_CONCURRENCY = 8
+EDIT_ATTEMPTS = 3
+EDIT_TIMEOUT = 60
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.propagate = False
 
 log_formatter = logging.Formatter(fmt = "%(asctime)s %(name)s: [%(levelname)s] %(message)s", datefmt = "%Y-%m-%d %H:%M:%S")
 
-file_handler = TimedRotatingFileHandler(filename = LOGFILE, when = "d", interval = 30, backupCount = 5)
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(log_formatter)
+# logging from the event loop is only an enqueue, the file and console handlers live on the listener's thread
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+
+def start_log_listener() -> QueueListener:
+    os.makedirs(os.path.dirname(LOGFILE), exist_ok = True)
+
+    file_handler = TimedRotatingFileHandler(filename = LOGFILE, when = "d", interval = 30, backupCount = 5, delay = True)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(log_formatter)
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.WARNING)
-console_handler.setFormatter(log_formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.WARNING)
+    console_handler.setFormatter(log_formatter)
 
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level = True)
+    listener.start()
+    return listener
+
+def stop_log_listener(listener: QueueListener):
+    # stop() processes everything still in the queue before joining the thread
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
 
 def load_external_config():
-    import json
     with open(os.path.join(COG_PATH, "config.json"), "r") as f:
         return json.loads(f.read())
 
+def embed_fingerprint(embed: discord.Embed) -> str:
+    # the timestamp changes on every render, it alone is no reason to edit the message
+    embed_data = embed.to_dict()
+    embed_data.pop('timestamp', None)
+    return json.dumps(embed_data, sort_keys = True)
+
+async def with_backoff(func, attempts = EDIT_ATTEMPTS, base_delay = 1.0):
+
+    """
+    Await func(), retrying rate limited and server side failures with exponential backoff.
+    discord.py already retries these internally, this only covers what it gives up on.
+    """
+
+    for attempt in range(attempts):
+        try:
+            return await func()
+        except discord.HTTPException as e:
+            retryable = isinstance(e, discord.DiscordServerError) or e.status == 429
+            if not retryable or attempt == attempts - 1:
+                raise
+            await asyncio.sleep(base_delay * 2 ** attempt + random.random())
+
+
 
 
 class Palantir(commands.Cog):
 
     def __init__(self, bot: bot.Red):
 
+        # only what can't fail and doesn't touch the disk happens here, the rest is left to cog_load
+        # so `[p]load` and `[p]reload` don't block the event loop
         self.bot = bot
 
-        guild_defaults = {
-            "channel_id": 0,
-            "embed_id": 0,
-            "role_to_notify": 0,
-            "bot_config_channel": 0,
-        }
-
         # pyzandro.set_log_target(r'/home/kulta/Sync/palantir/pyzandro_packets.log')
 
         self.config:Config = Config.get_conf(self, identifier = 3583395656)
-        self.config.register_guild(**guild_defaults)
+        self.config.register_guild(**GUILD_DEFAULTS)
+        self.guild_configs = {}
+
+        self.config_external = {}
+
+        self.active_servers = set()
+
+        self.notification_tasks = set()
+
+        self.metrics_server = None
+        self.status_document = StatusDocument()
+        self.status_server = None
+
+        self.geoip = GeoIpResolver()
+
+        self.server_states = {}
+        self.server_filters = {}
+        self.stale_servers = set()
+        self.last_state = None
+        self.presence_players = None
+
+        # other cogs can follow server changes through bot.get_cog("Palantir").events
+        self.events = EventBus()
+        self.recorder = None
+        self.tick_profiler = None
+
+        self.scanner_client = None
+        self.scanner_process = None
+        self.scanner_ticks = False
+
+        # only one scan at a time, whether it comes from the scheduled task or a command
+        self.scan_lock = asyncio.Lock()
 
-        self.config_external = load_external_config()
+        self.field_cache = {}
+        self.posted_fingerprints = {}
+        self.message_handles = {}
+        self.edit_semaphore = asyncio.Semaphore(EDIT_CONCURRENCY)
 
-        self.active_servers = []
-        self.serverlist_cache = []
-        self.fail_counter = 0
+        self.started_at = time.monotonic()
+        self.first_embed_at = None
+        self.first_live_embed_at = None
+        self.warm_started = False
 
-        self.sched_task.start()
+    def setup_components(self):
 
+        """Builds everything that is configured in the external JSON, once it is loaded"""
 
+        notification_config = self.config_external.get('notifications', {})
+        self.activity_tracker = ActivityTracker(hysteresis = notification_config.get('hysteresis', DEFAULT_HYSTERESIS))
+        self.send_limiter = SendLimiter(concurrency = notification_config.get('concurrency', DEFAULT_SEND_CONCURRENCY),
+            rate = notification_config.get('rate', DEFAULT_SEND_RATE))
 
-    def cog_unload(self):
+        metrics_config = self.config_external.get('metrics', {})
+        self.metrics = Metrics(history = metrics_config.get('history', DEFAULT_HISTORY))
+
+        # master list, queries, classification and scheduling, the same the shared scanner runs
+        self.pipeline = ScanPipeline(self.config_external, logger = logger, metrics = self.metrics)
+
+        # with a shared scanner configured, ticks come from it and the cog only scans while it is unreachable
+        scanner_config = self.config_external.get('scanner', {})
+        if scanner_config.get('socket'):
+            # only needed with a scanner configured
+            from .scanner import DEFAULT_RETRY_INTERVAL, ScannerClient
+            self.scanner_client = ScannerClient(scanner_config['socket'],
+                retry_interval = scanner_config.get('retry_interval', DEFAULT_RETRY_INTERVAL))
+
+
+
+    async def cog_load(self):
+        self.log_listener = start_log_listener()
+
+        try:
+            await self.initialize()
+
+            self.metrics.start_loop_monitor()
+            await self.start_metrics_server()
+            await self.start_status_server()
+
+            if self.config_external.get('scanner', {}).get('spawn'):
+                await self.spawn_scanner()
+
+            self.sched_task.change_interval(seconds = self.pipeline.resolution)
+            self.sched_task.start()
+        except BaseException:
+            # cog_unload isn't called when loading fails, the next load would start a second listener on the same queue
+            stop_log_listener(self.log_listener)
+            raise
+
+    async def cog_unload(self):
         self.sched_task.cancel()
+        for task in self.notification_tasks:
+            task.cancel()
+        self.events.close()
+
+        # both wait for their writer threads to finish
+        loop = asyncio.get_running_loop()
+        if self.recorder is not None:
+            await loop.run_in_executor(None, self.recorder.close)
+        if self.tick_profiler is not None:
+            self.tick_profiler.stop()
+        # a scanner this cog started is left running for the other subscribers, it exits by itself once nobody is left
+        if self.scanner_client is not None:
+            self.scanner_client.close()
+        self.metrics.stop_loop_monitor()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        if self.status_server is not None:
+            await self.status_server.stop()
+        self.pipeline.close()
+        self.geoip.close()
+        await loop.run_in_executor(None, self.history.close)
         
         logger.info("Palantir unloaded")
-        
-        while logger.hasHandlers():
-           logger.removeHandler(logger.handlers[0])
-        
-        del file_handler
-        del console_handler
+
+        stop_log_listener(self.log_listener)
+
+        while logger.handlers:
+            logger.removeHandler(logger.handlers[0])
+
+    async def initialize(self):
+
+        """Everything loading the cog needs from the disk, read in the executor"""
+
+        loop = asyncio.get_running_loop()
+
+        self.config_external = await loop.run_in_executor(None, load_external_config)
+        self.setup_components()
+
+        # cog_data_path creates the directory
+        data_path = await loop.run_in_executor(None, cog_data_path, self)
+        self.state_file = data_path / "state.json"
+        self.history = HistoryStore(data_path / "history.sqlite3")
+
+        await self.restore_state()
+
+        # guild settings are read from Config once here and kept in sync by the commands that change them,
+        # so the scheduled task never has to touch the Config backend
+        self.guild_configs = await self.config.all_guilds()
+        self.rebuild_filter_index()
+
+        try:
+            await self.history.open()
+        except sqlite3.Error as e:
+            logger.error(f"Could not open the history database: {e}")
+
+        if not await self.geoip.open():
+            logger.warning("GeoIP database not available, servers are listed without country flags")
 
     async def red_delete_data_for_user(self, **kwargs):
-        """ Nothing to delete, this cog does not store user data """
+        """ Nothing to delete, this cog stores no Discord user data, only in-game names of players seen on game servers """
         return
 
+    async def start_metrics_server(self):
+        # the Prometheus endpoint is off unless a port is configured, and only listens locally by default
+        metrics_config = self.config_external.get('metrics', {})
+        if not metrics_config.get('port'):
+            return
+
+        server = MetricsServer(self.metrics, metrics_config.get('host', "127.0.0.1"), metrics_config['port'])
+        try:
+            await server.start()
+            self.metrics_server = server
+            logger.info(f"Serving metrics on http://{server.host}:{server.port}/metrics")
+        except OSError as e:
+            logger.error(f"Could not start the metrics endpoint: {e}")
+
+    async def start_status_server(self):
+        # same as the metrics endpoint: off unless a port is configured, local only by default
+        status_config = self.config_external.get('status_api', {})
+        if not status_config.get('port'):
+            return
+
+        server = StatusServer(self.status_document, status_config.get('host', "127.0.0.1"), status_config['port'])
+        try:
+            await server.start()
+            self.status_server = server
+            logger.info(f"Serving the server list on http://{server.host}:{server.port}/status")
+        except OSError as e:
+            logger.error(f"Could not start the status endpoint: {e}")
+
+    async def spawn_scanner(self):
+        if self.scanner_client is None:
+            logger.error("scanner.spawn is set but scanner.socket isn't, not starting a scanner")
+            return
+
+        # another bot on this machine may have started one already
+        if await self.scanner_client.ensure_connected():
+            return
+
+        if self.scanner_process is not None and self.scanner_process.returncode is None:
+            # ours is still starting up
+            return
+
+        from .scanner import DEFAULT_IDLE_EXIT
+
+        idle_exit = self.config_external.get('scanner', {}).get('idle_exit', DEFAULT_IDLE_EXIT)
+        package = os.path.basename(COG_PATH)
+        try:
+            # in a session of its own, so it outlives this cog and isn't hit by signals meant for the bot
+            self.scanner_process = await asyncio.create_subprocess_exec(sys.executable, "-m", f"{package}.scanner",
+                "--socket", self.scanner_client.socket_path, "--config", os.path.join(COG_PATH, "config.json"),
+                "--idle-exit", str(idle_exit), cwd = os.path.dirname(COG_PATH), start_new_session = True)
+            logger.info(f"Started scanner process {self.scanner_process.pid} on {self.scanner_client.socket_path}")
+        except OSError as e:
+            logger.error(f"Could not start the scanner process: {e}")
+
+        # connect as soon as it is listening instead of waiting out the retry interval
+        self.scanner_client.next_attempt = 0
+
+
+
+    def guild_config(self, guild_id) -> dict:
+        return self.guild_configs.get(guild_id, GUILD_DEFAULTS)
+
+    async def set_guild_setting(self, guild_id, key, value):
+        await self.config.guild_from_id(guild_id).set_raw(key, value = value)
+        self.guild_configs.setdefault(guild_id, dict(GUILD_DEFAULTS))[key] = value
+        self.rebuild_filter_index()
 
+    async def clear_guild_settings(self, guild_id):
+        await self.config.guild_from_id(guild_id).clear()
+        self.guild_configs.pop(guild_id, None)
+        self.posted_fingerprints.pop(guild_id, None)
+        self.message_handles.pop(guild_id, None)
+        self.rebuild_filter_index()
 
-    @tasks.loop(minutes = 4)
+    def rebuild_filter_index(self):
+        index = FilterIndex({guild_id: config_data['filters'] for guild_id, config_data in self.guild_configs.items()})
+
+        if self.pipeline.set_filters(index):
+            self.activity_tracker.reset()
+
+        if self.scanner_client is not None:
+            self.scanner_client.send_filters(index.filters)
+
+        for address, server in list(self.server_states.items()):
+            self.server_filters[address] = index.classify_snapshot(server)
+            if len(self.server_filters[address]) == 0:
+                self.forget_server(address)
+
+        self.last_state = None
+
+    def forget_server(self, address):
+        server = self.server_states.pop(address, None)
+        self.server_filters.pop(address, None)
+        self.stale_servers.discard(address)
+
+        if server is not None:
+            self.events.publish(diff_snapshots(server, None))
+
+    def filter_views(self, qcde_servers) -> dict:
+
+        """Returns the servers each distinct guild filter matches"""
+
+        views = {key: [] for key in self.pipeline.filter_index.filters}
+        for server in qcde_servers:
+            for key in self.server_filters.get(server.address, ()):
+                views[key].append(server)
+        return views
+
+
+
+    @tasks.loop(seconds = DEFAULT_RESOLUTION)
     async def sched_task(self):
 
         await self.bot.wait_until_red_ready()
 
-        all_configs = await self.config.all_guilds()
-
-        if len(all_configs) == 0:
+        if len(self.guild_configs) == 0:
             logger.warning("There seem to be no active embeds. Stopping.")
             self.sched_task.stop()
 
+        if self.scan_lock.locked():
+            # a scan started elsewhere is still going, its results are published when it is done
+            self.metrics.count("ticks_skipped")
+            logger.debug("Previous scan is still running, skipping this tick")
+            return
+
+        async with self.scan_lock:
+            profiler = self.tick_profiler
+            if profiler is None:
+                await self.run_tick()
+            else:
+                with profiler.profile_tick() as tick:
+                    tick.counts = await self.run_tick()
+
+    async def run_tick(self) -> bool:
+
+        """Returns whether anything was polled"""
+
+        tick_start = time.perf_counter()
+        deadline = asyncio.get_running_loop().time() + self.pipeline.tick_deadline
+        polled = False
+
         try:
-            qcde_servers = await self.scan_servers()
-            total_players = await self.check_activity(qcde_servers)
+            # after a restart the embeds are brought up to date from the saved state before the first scan goes out
+            if self.warm_started and self.first_embed_at is None:
+                await self.publish_state()
+                self.first_embed_at = time.monotonic() - self.started_at
+
+            if self.scanner_client is not None and await self.connect_scanner():
+                polled = self.apply_scanner_ticks()
+                self.scanner_ticks = True
+            else:
+                if self.scanner_ticks:
+                    self.resync_schedule()
+                polled = await self.scan_tick(deadline)
+
+            await self.publish_state()
+
+            if polled:
+                await self.persist_state()
+                await self.history.flush()
+
+                if self.first_live_embed_at is None:
+                    self.first_live_embed_at = time.monotonic() - self.started_at
+                    self.report_startup()
+
+                # ticks with nothing due are next to free and would only drown out the real ones
+                self.metrics.record("tick", time.perf_counter() - tick_start)
 
-            await self.update_embed(qcde_servers)
-            await self.bot.change_presence(activity = discord.Game(f"QC:DE: {total_players} online"))
         except ConnectionResetError as e:
             logger.error(f"Could not update bot status: {e}")
         except Exception:
             logger.exception("sched_task exception")
 
-    async def scan_servers(self) -> list:
-        try:
-            server_addresses = pyzandro.query_master('master.qzandronum.com:15300')
-            self.serverlist_cache = server_addresses
-            self.fail_counter = 0
-        except PyZandroException:
-            logger.warning("The master server did not respond. Working from cache.")
-            server_addresses = self.serverlist_cache
-            self.fail_counter += 1
-        except TimeoutError:
-            logger.warning("Request to the master server timed out. Working from cache.")
-            server_addresses = self.serverlist_cache
-            self.fail_counter += 1
-
-        qcde_serverdata = []
-
-        for server in server_addresses:
-            try:
-                server_info = {}
-                server_info = pyzandro.query_server(server, flags = [SQF.NAME, SQF.MAPNAME, SQF.NUMPLAYERS, SQF.PLAYERDATA, SQF.GAMETYPE, SQF.PWADS, SQF.FORCEPASSWORD, SQF.FORCEJOINPASSWORD])
-                for wad_bytes in server_info['pwads']:
-                    wad = str(wad_bytes, 'utf-8')
-                    if ("qcdev" in wad.lower()):
-                        server_info['address'] = server
-                        qcde_serverdata.append(server_info)
-                        break
-            except PyZandroException as e:
-                logger.error(f"Game server on {server} did not respond: {e}")
-                continue
-            except TimeoutError:
-                server_info['name_nocolor'] = "Connection timeout..."
-            except ConnectionResetError:
-                server_info['name_nocolor'] = "Connection reset..."
-            except Exception:
-                logger.exception("Exception after querying")
-                continue
+        return polled
+
+    async def scan_tick(self, deadline) -> bool:
+        result = await self.pipeline.poll(self.server_states, deadline = deadline)
+        if result is None:
+            return False
+
+        if result.serverlist is not None:
+            self.apply_master_list(result.serverlist)
+
+        for server in result.snapshots:
+            self.server_filters[server.address] = self.pipeline.classification_cache.get(server.address)
+        self.apply_scan(result.snapshots, result.outcomes)
+
+        if self.recorder is not None:
+            self.recorder.record(result.timings, result.serverlist, result.polled, result.snapshots, result.cut_off,
+                failed = result.failed, master_failures = self.pipeline.fail_counter)
+
+        return True
+
+    async def connect_scanner(self) -> bool:
+        attempting = time.monotonic() >= self.scanner_client.next_attempt
+        if await self.scanner_client.ensure_connected():
+            return True
+
+        # the scanner exited or was never started, start one again rather than scanning in-process for good
+        if attempting and self.config_external.get('scanner', {}).get('spawn'):
+            await self.spawn_scanner()
+        return False
+
+    def resync_schedule(self):
+        # nothing was popped from the schedule while the scanner polled, whatever came due meanwhile is polled first
+        self.pipeline.poll_scheduler.sync(self.pipeline.serverlist)
+        self.scanner_ticks = False
+
+    def apply_scanner_ticks(self) -> bool:
+        records = self.scanner_client.drain()
+
+        for record in records:
+            servers = self.apply_recorded_tick(record)
+            if self.recorder is not None:
+                self.recorder.record(record["timings"], record["serverlist"], record["polled"], servers, record["cut_off"],
+                    failed = record.get("failed"), master_failures = record.get("master_failures"), ts = record["ts"])
+
+        return len(records) > 0
+
+    def apply_recorded_tick(self, record) -> list:
+
+        """Apply a tick scanned elsewhere, by the shared scanner or in a recording. Returns the servers kept."""
 
-        return qcde_serverdata
+        if record["serverlist"] is not None:
+            self.pipeline.serverlist = record["serverlist"]
+            self.pipeline.prune(record["serverlist"])
+            self.apply_master_list(record["serverlist"])
 
-    async def check_activity(self, qcde_serverinfolist) -> int:
+        # older recordings don't carry the master's and the servers' health
+        if record.get("master_failures") is not None:
+            self.pipeline.fail_counter = record["master_failures"]
+
+        failed = record.get("failed", {})
+        cut_off = set(record["cut_off"])
+        for address in record["polled"]:
+            if address in failed:
+                self.pipeline.server_health.record_failure(address, failed[address])
+            elif address not in cut_off:
+                self.pipeline.server_health.record_success(address)
+
+        servers = []
+        for server in record["servers"]:
+            # the scanner doesn't know about guild filters, they are applied here
+            matches = self.pipeline.filter_index.classify_snapshot(server)
+            if matches:
+                self.server_filters[server.address] = matches
+                servers.append(server)
+
+        # the schedule belongs to whoever polled, it is picked up again by resync_schedule
+        outcomes = self.pipeline.settle(record["polled"], servers, cut_off, failed, self.server_states, reschedule = False)
+        self.apply_scan(servers, outcomes)
+        return servers
+
+    async def publish_state(self):
+        # the embed and activity state only need attention when something visible has changed
+        qcde_servers = list(self.server_states.values())
+        state = (tuple(server.fingerprint for server in qcde_servers), self.pipeline.fail_counter > 5, frozenset(self.stale_servers))
+
+        if state == self.last_state:
+            return
+        self.last_state = state
+
+        with self.metrics.time("activity"):
+            total_players = await self.check_activity(qcde_servers)
+
+        self.update_status_document(qcde_servers)
+
+        await self.update_embed(qcde_servers)
+
+        # the presence only shows the player count, players moving between servers don't change it
+        if total_players != self.presence_players:
+            await self.bot.change_presence(activity = discord.Game(f"QC:DE: {total_players} online"))
+            self.presence_players = total_players
+
+    def update_status_document(self, qcde_servers):
+        servers = []
+        for server in qcde_servers:
+            server_data = server.to_dict()
+            server_data['stale'] = server.address in self.stale_servers
+            servers.append(server_data)
+
+        self.status_document.update({
+            "updated": datetime.now(timezone.utc).isoformat(),
+            "master_available": self.pipeline.fail_counter <= 5,
+            "servers": servers,
+        })
+
+    async def restore_state(self):
+        loop = asyncio.get_running_loop()
+        state = await loop.run_in_executor(None, load_state, self.state_file)
+        if state is None:
+            return
+
+        serverlist, servers, active_servers = state
+
+        self.pipeline.serverlist = serverlist
+        self.server_states = {server.address: server for server in servers}
+        # classified against the guild filters once those are loaded in cog_load
+        self.active_servers = active_servers
+        self.activity_tracker.seed(active_servers)
+        self.pipeline.poll_scheduler.sync(serverlist)
+        self.warm_started = True
+
+        logger.info(f"Restored {len(servers)} servers from {self.state_file}")
+
+    async def persist_state(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, save_state, self.state_file,
+                self.pipeline.serverlist, list(self.server_states.values()), set(self.active_servers))
+        except OSError as e:
+            logger.error(f"Could not save state: {e}")
+
+    def report_startup(self):
+        if self.first_embed_at is not None:
+            logger.info(f"Startup: embeds restored from saved state after {self.first_embed_at:.2f}s, "
+                f"first live scan published after {self.first_live_embed_at:.2f}s")
+        else:
+            logger.info(f"Startup: first live scan published after {self.first_live_embed_at:.2f}s")
+
+    def apply_master_list(self, server_addresses):
+        for address in [a for a in self.server_states if a not in server_addresses]:
+            self.forget_server(address)
+
+    def apply_scan(self, qcde_servers, outcomes):
+        results = {server.address: server for server in qcde_servers}
+        self.history.record(qcde_servers)
+
+        for address, outcome in outcomes.items():
+            if outcome == ANSWERED:
+                server = results[address]
+                self.events.publish(diff_snapshots(self.server_states.get(address), server))
+                self.server_states[address] = server
+                self.stale_servers.discard(address)
+            elif outcome == CUT_OFF:
+                # the server never got its chance to answer, the last known state stays listed until the next tick asks again
+                if address in self.server_states:
+                    self.stale_servers.add(address)
+            elif outcome == STALE:
+                # a single lost reply doesn't take a populated server off the embed, it is asked again soon
+                self.stale_servers.add(address)
+            else:
+                self.forget_server(address)
+
+    async def check_activity(self, qcde_servers) -> int:
         active_servers = self.active_servers
         total_players = 0
 
-        for serverinfo in qcde_serverinfolist:
-
-            address = serverinfo['address']
-            num_players = serverinfo['num_players']
+        for server in qcde_servers:
 
-            for player in serverinfo['players']:
-                if player['bot'] == 1:
-                    num_players -= 1
+            address = server.address
+            num_players = server.humans
 
             if num_players >= 1 and not address in active_servers:
-                active_servers.append(address)
-                logger.info("%-20s %-25s %s", "Player activity on", address, serverinfo['name_nocolor'])
-
-                if len(active_servers) == 1:
-                    await self.ping_subscribers()
+                active_servers.add(address)
+                logger.info("%-20s %-25s %s", "Player activity on", address, server.name)
 
             if num_players < 1 and address in active_servers:
-                active_servers.remove(address)
-                logger.info("%-20s %-25s %s", "Server empty", address, serverinfo['name_nocolor'])
+                active_servers.discard(address)
+                logger.info("%-20s %-25s %s", "Server empty", address, server.name)
 
             total_players += num_players
 
         # remove servers that are not reported by master
-        addresses_from_master = [s['address'] for s in qcde_serverinfolist]
-        leftover_servers = set(active_servers) - set(addresses_from_master)
+        leftover_servers = active_servers - {server.address for server in qcde_servers}
         for leftover_address in leftover_servers:
-            active_servers.remove(leftover_address)
-            logger.info("%-20s %s", "Leftover server", address)
+            active_servers.discard(leftover_address)
+            logger.info("%-20s %s", "Leftover server", leftover_address)
+
+        # a guild is notified when the first server in its own view becomes active, servers that
+        # only just emptied out still count as active so flapping doesn't ping over and over
+        filters_to_ping = self.activity_tracker.update(qcde_servers, self.server_filters)
+
+        if len(filters_to_ping) > 0:
+            # the pings go out in the background, the embeds don't have to wait for them
+            task = asyncio.ensure_future(self.ping_subscribers(self.pipeline.filter_index.guilds(filters_to_ping)))
+            self.notification_tasks.add(task)
+            task.add_done_callback(self.notification_tasks.discard)
 
         return total_players
 
-    async def generate_embed(self, qcde_servers) -> discord.Embed:
-        embed = discord.Embed(title = "QC:DE Servers", description = "​")
-        embed.set_author(name = "Palantir", icon_url = self.config_external['icon'])
+    async def render_server_field(self, server) -> tuple:
+        player_list = []
+        playernum = server.humans
 
-        try:
-            for server in qcde_servers:
+        for player in server.players:
 
-                player_list = []
-                playernum = server['num_players']
+            if player.is_bot:
+                playername = f":robot: *{player.name}*"
+            else:
+                playername = f"**{player.name}**"
 
-                for player in server['players']:
+            player_list.append(playername)
 
-                    playername = player['name_nocolor']
+        if playernum > 0:
+            indicator = ":green_circle:"
+        else:
+            indicator = ":black_circle:"
 
-                    if player['bot'] == 1:
-                        playername = f":robot: *{playername}*"
-                        playernum -= 1
-                    else:
-                        playername = f"**{playername}**"
+        if server.locked:
+            locked = ":lock:"
+        else:
+            locked = ""
 
-                    player_list.append(playername)
+        player_list.sort()
+        player_list_formatted = ', '.join(player_list)
 
-                if playernum > 0:
-                    indicator = ":green_circle:"
-                else:
-                    indicator = ":black_circle:"
+        server_address = str(server.address).split(":")
+        server_country_flag = ""
 
-                if server['forcepassword'] == True or server['forcejoinpassword'] == True:
-                    locked = ":lock:"
-                else:
-                    locked = ""
+        try:
+            country = await self.geoip.resolve(server_address[0])
+            server_country_flag = f":flag_{country.lower()}:"
+        except GeoIpHelperException as e:
+            logger.warning(f"Error retrieving server country: {e}")
+
+        return (playernum,
+            f"{server_country_flag} {locked} {server.name} - [{server.mapname}]",
+            f"{indicator} Players [{playernum}]: {player_list_formatted}")
 
-                player_list.sort()
-                player_list_formatted = ', '.join(player_list)
+    async def generate_embed(self, qcde_servers, title = DEFAULT_FILTER['title']) -> discord.Embed:
+        embed = discord.Embed(title = title, description = "​")
+        embed.set_author(name = "Palantir", icon_url = self.config_external['icon'])
 
-                server_address = str(server['address']).split(":")
-                server_country_flag = ""
+        try:
+            for server in qcde_servers:
 
-                try:
-                    country = query_geoip(server_address[0])
-                    server_country_flag = f":flag_{country.lower()}:"
-                except GeoIpHelperException as e:
-                    logger.warning(f"Error retrieving server country: {e}")
+                # servers whose visible state hasn't changed since the last render reuse their field strings
+                fingerprint = server.fingerprint
+                field = self.field_cache.get(fingerprint)
+                if field is None:
+                    field = await self.render_server_field(server)
+                    self.field_cache[fingerprint] = field
+
+                playernum, field_name, field_value = field
+
+                if server.address in self.stale_servers:
+                    field_name = f":hourglass: {field_name}"
 
                 if playernum > 0:
-                    embed.add_field(name = f"{server_country_flag} {locked} {server['name_nocolor']} - [{server['mapname']}]",
-                        value = f"{indicator} Players [{playernum}]: {player_list_formatted}", inline = False)
+                    embed.add_field(name = field_name, value = field_value, inline = False)
 
         except Exception:
             logger.exception("Palantir error")
 
-        if self.fail_counter > 5:
+        if self.pipeline.fail_counter > 5:
             embed.set_thumbnail(url = self.config_external['thumbnail']['ded'])
             embed.color = 0x222222
             embed.add_field(name = "Service currently unavailable",
@@ -276,62 +753,141 @@ class Palantir(commands.Cog):
         return embed
 
     async def update_embed(self, qcde_servers):
-        embed = await self.generate_embed(qcde_servers)
+        views = self.filter_views(qcde_servers)
 
-        all_configs = await self.config.all_guilds()
+        # guilds with the same filter and title share one rendered embed
+        embeds = {}
+        edits = []
 
-        for guild_id, config_data in all_configs.items():
-            msg_id = config_data['embed_id']
-            channel = self.bot.get_channel(config_data['channel_id'])
+        render_start = time.perf_counter()
 
-            try:
-                msg = await channel.fetch_message(msg_id)
-            except AttributeError:
-                logger.error("Couldn't fetch embed for %s, channel is None", self.bot.get_guild(guild_id).name)
-                continue
-            except discord.DiscordServerError as e:
-                logger.error(f"Could not retrieve embed to be edited for {self.bot.get_guild(guild_id).name}: {e}")
-                continue
-            except discord.NotFound as e:
-                logger.error(f"Could not found embed for {self.bot.get_guild(guild_id).name}: {e}")
+        for guild_id, config_data in list(self.guild_configs.items()):
+            if config_data['embed_id'] == 0:
                 continue
 
-            if config_data['bot_config_channel'] != 0:
-                config_channel = self.bot.get_channel(config_data['bot_config_channel'])
+            key = self.pipeline.filter_index.guild_filters.get(guild_id)
+            title = config_data['filters'].get('title', DEFAULT_FILTER['title'])
+
+            if (key, title) not in embeds:
+                embed = await self.generate_embed(views.get(key, []), title = title)
+                embeds[(key, title)] = (embed, embed_fingerprint(embed))
+
+            embed, fingerprint = embeds[(key, title)]
+            edits.append(self.edit_guild_embed(guild_id, config_data, embed, fingerprint))
+
+        self.metrics.record("render", time.perf_counter() - render_start)
+
+        # fields of servers that are gone or have changed won't be asked for again
+        current = {server.fingerprint for server in qcde_servers}
+        self.field_cache = {fingerprint: field for fingerprint, field in self.field_cache.items() if fingerprint in current}
+
+        # every guild's embed lives in its own channel, so the edits fall into separate rate limit buckets and can go out together
+        with self.metrics.time("fanout"):
+            results = await asyncio.gather(*edits, return_exceptions = True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Exception while editing embed", exc_info = result)
+
+        if not all(result is True for result in results):
+            # guilds whose edit didn't land are tried again next tick, even if nothing changes meanwhile
+            self.last_state = None
+
+    def get_message_handle(self, guild_id, config_data):
+
+        """Returns a cached PartialMessage for the guild's embed, so editing it needs no extra fetch"""
+
+        handle = self.message_handles.get(guild_id)
+        if handle is not None and handle.channel.id == config_data['channel_id'] and handle.id == config_data['embed_id']:
+            return handle
+
+        channel = self.bot.get_channel(config_data['channel_id'])
+        if channel is None:
+            return None
+
+        handle = channel.get_partial_message(config_data['embed_id'])
+        self.message_handles[guild_id] = handle
+        return handle
+
+    async def edit_guild_embed(self, guild_id, config_data, embed, fingerprint) -> bool:
+
+        """Returns whether the guild's embed shows `embed` now"""
+
+        if self.posted_fingerprints.get(guild_id) == fingerprint:
+            self.metrics.count("edits_skipped")
+            return True
+
+        msg = self.get_message_handle(guild_id, config_data)
+
+        if msg is None:
+            self.metrics.count("edits_failed")
+            logger.error("Couldn't fetch embed for %s, channel is None", self.bot.get_guild(guild_id).name)
+            return False
+
+        if config_data['bot_config_channel'] != 0:
+            config_channel = self.bot.get_channel(config_data['bot_config_channel'])
 
+        async with self.edit_semaphore:
             try:
-                await msg.edit(embed = embed)
+                await asyncio.wait_for(with_backoff(lambda: msg.edit(embed = embed)), EDIT_TIMEOUT)
+                self.posted_fingerprints[guild_id] = fingerprint
+                self.metrics.count("edits_sent")
+                return True
+            except discord.NotFound as e:
+                self.metrics.count("edits_failed")
+                self.message_handles.pop(guild_id, None)
+                logger.error(f"Could not found embed for {self.bot.get_guild(guild_id).name}: {e}")
             except discord.Forbidden:
+                self.metrics.count("edits_failed")
                 if config_data['bot_config_channel'] != 0:
                     await config_channel.send("Palantir error: `No permission to edit message`")
-            except discord.DiscordServerError as e:
+            except discord.HTTPException as e:
+                self.metrics.count("edits_failed")
                 logger.error(f"Could not edit the embed for {self.bot.get_guild(guild_id).name}: {e}")
+            except (TimeoutError, asyncio.TimeoutError):
+                self.metrics.count("edits_failed")
+                logger.error(f"Editing the embed for {self.bot.get_guild(guild_id).name} timed out")
 
+        return False
 
-    async def ping_subscribers(self):
-        allowed_mentions = discord.AllowedMentions(roles = True)
+    async def ping_subscribers(self, guild_ids):
+        # one message per guild no matter how many of its servers became active, all guilds at once
+        results = await asyncio.gather(*(self.ping_guild(guild_id) for guild_id in guild_ids), return_exceptions = True)
 
-        all_configs = await self.config.all_guilds()
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Exception while notifying", exc_info = result)
 
-        for guild_id, config_data in all_configs.items():
+    async def ping_guild(self, guild_id):
+        allowed_mentions = discord.AllowedMentions(roles = True)
+
+        config_data = self.guild_configs.get(guild_id)
+        if config_data is None:
+            return
 
-            guild_obj = self.bot.get_guild(guild_id)
-            channel = self.bot.get_channel(config_data['channel_id'])
+        guild_obj = self.bot.get_guild(guild_id)
+        channel = self.bot.get_channel(config_data['channel_id'])
+        if guild_obj is None or channel is None:
+            return
 
-            if config_data['role_to_notify'] == 0:
-                mention_string = ""
-            else:
-                role_obj = guild_obj.get_role(config_data['role_to_notify'])
+        mention_string = ""
+        if config_data['role_to_notify'] != 0:
+            role_obj = guild_obj.get_role(config_data['role_to_notify'])
+            if role_obj is not None:
                 mention_string = role_obj.mention
 
-            if config_data['bot_config_channel'] != 0:
-                config_channel = self.bot.get_channel(config_data['bot_config_channel'])
+        if config_data['bot_config_channel'] != 0:
+            config_channel = self.bot.get_channel(config_data['bot_config_channel'])
 
-            try:
-                await channel.send(f"{mention_string} A warrior has entered the arenas", allowed_mentions = allowed_mentions, delete_after = 1)
-            except discord.Forbidden:
-                if config_data['bot_config_channel'] != 0:
-                    await config_channel.send(f"Palantir error: `No permission to send messages in` {self.bot.get_channel(channel).mention}")
+        try:
+            async with self.send_limiter:
+                await with_backoff(lambda: channel.send(f"{mention_string} A warrior has entered the arenas",
+                    allowed_mentions = allowed_mentions, delete_after = 1))
+        except discord.Forbidden:
+            if config_data['bot_config_channel'] != 0:
+                await config_channel.send(f"Palantir error: `No permission to send messages in` {channel.mention}")
+        except discord.HTTPException as e:
+            logger.error(f"Could not notify {guild_obj.name}: {e}")
 
 
 
@@ -359,7 +915,7 @@ class Palantir(commands.Cog):
 
         """
 
-        if await self.config.guild(ctx.guild).embed_id() != 0:
+        if self.guild_config(ctx.guild.id)['embed_id'] != 0:
             await ctx.send("You already seem to have set up an embed for this guild. Please use the `delete` command before setting a new one up.")
             return
 
@@ -368,10 +924,10 @@ class Palantir(commands.Cog):
         else:
             embed_channel = ctx.guild.get_channel(channel_id)
 
-        await self.config.guild(ctx.guild).channel_id.set(embed_channel.id)
+        await self.set_guild_setting(ctx.guild.id, 'channel_id', embed_channel.id)
 
         if role_id is not None:
-            await self.config.guild(ctx.guild).role_to_notify.set(role_id)
+            await self.set_guild_setting(ctx.guild.id, 'role_to_notify', role_id)
             role_mention = ctx.guild.get_role(role_id).mention
         else:
             role_mention = "no role"
@@ -383,9 +939,13 @@ class Palantir(commands.Cog):
         await ctx.bot.wait_for("reaction_add", check = predicate)
 
         if predicate.result is True:
-            embed = await self.generate_embed([])
+            embed = await self.generate_embed([], title = self.guild_config(ctx.guild.id)['filters'].get('title', DEFAULT_FILTER['title']))
             msg = await embed_channel.send(embed = embed)
-            await self.config.guild(ctx.guild).embed_id.set(msg.id)
+            await self.set_guild_setting(ctx.guild.id, 'embed_id', msg.id)
+            # make sure the new embed gets filled in on the next tick even if no server has changed
+            self.last_state = None
+            self.posted_fingerprints.pop(ctx.guild.id, None)
+            self.message_handles.pop(ctx.guild.id, None)
         else:
             await ctx.send("Cancelled.")
             return
@@ -405,7 +965,7 @@ class Palantir(commands.Cog):
             await ctx.send("Guild ID doesn't match the guild you're issuing the command from.")
             return
 
-        all_configs = await self.config.all_guilds()
+        all_configs = self.guild_configs
 
         if len(all_configs) == 0:
             ctx.send("It seems you don't have anything set up yet.")
@@ -441,7 +1001,7 @@ class Palantir(commands.Cog):
             await ctx.bot.wait_for("reaction_add", check = predicate)
 
             if predicate.result is True:
-                await self.config.guild_from_id(guildID).clear()
+                await self.clear_guild_settings(guildID)
                 await ctx.send("Guild config purged.")
                 return
             else:
@@ -455,7 +1015,7 @@ class Palantir(commands.Cog):
             await ctx.send("Couldn't delete the embed, please make sure I have the right permissions!")
             return
 
-        await self.config.guild_from_id(guildID).clear()
+        await self.clear_guild_settings(guildID)
         await ctx.send(f"Deleted embed for `{self.bot.get_guild(guild_id).name}`")
 
 
@@ -503,15 +1063,116 @@ class Palantir(commands.Cog):
         else:
             await ctx.send("Server querying is already running.")
 
+    @palantir.group(name = "stats")
+    async def _stats(self, ctx: commands.Context):
+
+        """
+        Server activity statistics. All times are in UTC.
+        """
+
+        pass
+
+    @_stats.command(name = "peakhours")
+    async def _stats_peakhours(self, ctx: commands.Context, days: int = 7):
+
+        """
+        Show the busiest hours of the day over the last few days.
+        """
+
+        rows = await self.history.peak_hours(days)
+        if len(rows) == 0:
+            await ctx.send("No data yet.")
+            return
+
+        lines = [f"{'hour':<6} {'average':>8} {'highest':>8}"]
+        lines += [f"{hour:02d}:00  {average:>8.1f} {highest:>8}" for hour, average, highest in rows]
+        await ctx.send(box("\n".join(lines)))
+
+    @_stats.command(name = "uptime")
+    async def _stats_uptime(self, ctx: commands.Context, days: int = 7):
+
+        """
+        Show how many hours each server was up and had players on it over the last few days.
+        """
+
+        rows = await self.history.uptime(days)
+        if len(rows) == 0:
+            await ctx.send("No data yet.")
+            return
+
+        lines = []
+        for address, name, hours_seen, hours_active, average in rows:
+            lines.append(f"{name or address}\n    up {100 * hours_seen / (days * 24):.0f}% ({hours_seen}h), "
+                f"players on {hours_active}h, {average:.1f} players on average")
+
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
+    @_stats.command(name = "daily")
+    async def _stats_daily(self, ctx: commands.Context, days: int = 7):
+
+        """
+        Show how many different players showed up each day.
+        """
+
+        rows = await self.history.daily_active(days)
+        if len(rows) == 0:
+            await ctx.send("No data yet.")
+            return
+
+        lines = [f"{datetime.fromtimestamp(day, timezone.utc):%Y-%m-%d}  {players} players" for day, players in rows]
+        await ctx.send(box("\n".join(lines)))
+
+    @palantir.command(name = "metrics")
+    async def _metrics(self, ctx: commands.Context):
+
+        """
+        Show how long each part of the scheduled task takes, query round trips and embed edits.
+        """
+
+        lines = [f"{'phase':<10} {'last ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for phase, (last, p50, p99, highest) in self.metrics.phase_summary().items():
+            lines.append(f"{phase:<10} {last * 1000:>9.1f} {p50 * 1000:>9.1f} {p99 * 1000:>9.1f} {highest * 1000:>9.1f}")
+
+        lines.append("")
+        lines.append("query round trips:")
+        previous = 0
+        for bound, count in zip(RTT_BUCKETS, self.metrics.rtt_buckets):
+            lines.append(f"  <= {bound * 1000:>5.0f} ms  {count - previous}")
+            previous = count
+        lines.append(f"   > {RTT_BUCKETS[-1] * 1000:>5.0f} ms  {self.metrics.rtt_count - previous}")
+
+        lines.append("")
+        for counter, value in self.metrics.counters.items():
+            lines.append(f"{counter:<15} {value}")
+
+        if len(self.metrics.loop_lag) > 0:
+            lines.append("")
+            lines.append(f"event loop lag: p99 {percentile(self.metrics.loop_lag, 0.99) * 1000:.1f} ms, "
+                f"max {max(self.metrics.loop_lag) * 1000:.1f} ms")
+
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
     @palantir.command(name = "reload_json")
     async def _reload_config(self, ctx: commands.Context):
 
         """
-        Reload the external JSON file.
+        Reload the display settings from the external JSON file.
         """
 
-        self.config_external = load_external_config()
-        await ctx.send("External JSON reloaded.")
+        loop = asyncio.get_running_loop()
+        config_external = await loop.run_in_executor(None, load_external_config)
+
+        # the rest is built into the query engine, scheduler and endpoints when the cog loads
+        for key in DISPLAY_SETTINGS:
+            if key in config_external:
+                self.config_external[key] = config_external[key]
+
+        self.field_cache = {}
+        self.last_state = None
+        await ctx.send(f"Reloaded {', '.join(DISPLAY_SETTINGS)} from the external JSON. "
+            f"The other settings only take effect after `{ctx.clean_prefix}reload palantir`.")
 
 
 
@@ -528,7 +1189,7 @@ class Palantir(commands.Cog):
         """
 
         if role_id is None:
-            ping_role_id = await self.config.guild(ctx.guild).role_to_notify()
+            ping_role_id = self.guild_config(ctx.guild.id)['role_to_notify']
             if ping_role_id == 0:
                 await ctx.send("Role is `unset`")
             else:
@@ -536,7 +1197,7 @@ class Palantir(commands.Cog):
                 await ctx.send(f"Role to notify is currently set to: `{ping_role_name}`, ID: `{ping_role_id}`")
 
         else:
-            await self.config.guild(ctx.guild).role_to_notify.set(role_id)
+            await self.set_guild_setting(ctx.guild.id, 'role_to_notify', role_id)
             if role_id == 0:
                 await ctx.send("Role unset.")
             else:
@@ -551,7 +1212,7 @@ class Palantir(commands.Cog):
         """
 
         if channel_id is None:
-            conf_chan_id = await self.config.guild(ctx.guild).bot_config_channel()
+            conf_chan_id = self.guild_config(ctx.guild.id)['bot_config_channel']
             if conf_chan_id == 0:
                 await ctx.send("Bot config channel is `unset`.")
             else:
@@ -559,28 +1220,138 @@ class Palantir(commands.Cog):
                 await ctx.send(f"Bot settings channel currently set to: `{conf_chan_name}`, ID: `{conf_chan_id}`")
 
         else:
-            await self.config.guild(ctx.guild).bot_config_channel.set(channel_id)
+            await self.set_guild_setting(ctx.guild.id, 'bot_config_channel', channel_id)
             if channel_id == 0:
                 await ctx.send("Bot config channel unset.")
             else:
                 await ctx.send(f"Error messages will be sent to: {self.bot.get_channel(channel_id).mention}")
 
+    @palantir.group(name = "filter")
+    async def _filter(self, ctx: commands.Context):
+
+        """
+        Choose which servers are listed in this guild's embed.
+
+        Patterns are case-insensitive substrings, prefix them with `re:` to use a regular expression instead.
+        Regular expressions can repeat one part without a limit, but not repeat groups or use backreferences.
+        A server is listed when every category that has patterns has at least one matching pattern.
+        Categories: pwads, iwads, gametypes, names
+        """
+
+        pass
+
+    def copy_guild_filter(self, guild_id) -> dict:
+        guild_filter = self.guild_config(guild_id)['filters']
+        return {key: list(value) if isinstance(value, list) else value for key, value in guild_filter.items()}
+
+    @_filter.command(name = "show")
+    async def _filter_show(self, ctx: commands.Context):
+
+        """
+        Show this guild's filter.
+        """
+
+        guild_filter = self.guild_config(ctx.guild.id)['filters']
+        lines = [f"title: {guild_filter.get('title', DEFAULT_FILTER['title'])}"]
+
+        for category in CATEGORIES:
+            patterns = guild_filter.get(category, [])
+            lines.append(f"{category}: {', '.join(patterns) if patterns else '(any)'}")
+
+        await ctx.send(box("\n".join(lines)))
+
+    @_filter.command(name = "add")
+    async def _filter_add(self, ctx: commands.Context, category: str, *, pattern: str):
+
+        """
+        Add a pattern to one of the filter's categories.
+        """
+
+        category = category.lower()
+        if category not in CATEGORIES:
+            await ctx.send(f"Invalid category, use one of: {', '.join(CATEGORIES)}")
+            return
+
+        # a regular expression runs on the bot's event loop for every guild, so only the bot owner may add one
+        if pattern.startswith(REGEX_PREFIX) and not await self.bot.is_owner(ctx.author):
+            await ctx.send("Only the bot owner can add regular expression patterns.")
+            return
+
+        try:
+            compile_pattern(pattern)
+        except FilterException as e:
+            await ctx.send(str(e))
+            return
+
+        guild_filter = self.copy_guild_filter(ctx.guild.id)
+        if pattern in guild_filter.setdefault(category, []):
+            await ctx.send(f"`{pattern}` is already in {category}.")
+            return
+
+        guild_filter[category].append(pattern)
+        await self.set_guild_setting(ctx.guild.id, 'filters', guild_filter)
+        await ctx.send(f"Added `{pattern}` to {category}.")
+
+    @_filter.command(name = "remove")
+    async def _filter_remove(self, ctx: commands.Context, category: str, *, pattern: str):
+
+        """
+        Remove a pattern from one of the filter's categories.
+        """
+
+        category = category.lower()
+        guild_filter = self.copy_guild_filter(ctx.guild.id)
+
+        if pattern not in guild_filter.get(category, []):
+            await ctx.send(f"`{pattern}` is not in {category}.")
+            return
+
+        guild_filter[category].remove(pattern)
+        await self.set_guild_setting(ctx.guild.id, 'filters', guild_filter)
+        await ctx.send(f"Removed `{pattern}` from {category}.")
+
+    @_filter.command(name = "title")
+    async def _filter_title(self, ctx: commands.Context, *, title: str):
+
+        """
+        Set the title of this guild's embed.
+        """
+
+        guild_filter = self.copy_guild_filter(ctx.guild.id)
+        guild_filter['title'] = title
+        await self.set_guild_setting(ctx.guild.id, 'filters', guild_filter)
+        await ctx.send(f"Embed title set to `{title}`.")
+
+    @_filter.command(name = "reset")
+    async def _filter_reset(self, ctx: commands.Context):
+
+        """
+        Go back to listing QC:DE servers.
+        """
+
+        await self.set_guild_setting(ctx.guild.id, 'filters', DEFAULT_FILTER)
+        await ctx.send("Filter reset to the default.")
+
     @palantir.command(name = "setinterval")
     async def set_query_interval(self, ctx: commands.Context, hrs = 0, mins = 0, secs = 0):
 
         """
         Get or set server querying interval.
+        Servers with players on them are queried more often, this sets the interval for all other servers.
         Warning! This is a global setting and will affect all guilds.
         Query interval cannot be 0.
         """
 
         if all(arg == 0 for arg in [hrs, mins, secs]):
+            hrs, rest = divmod(int(self.pipeline.poll_scheduler.idle_interval), 3600)
+            mins, secs = divmod(rest, 60)
             await ctx.send(f"Server query interval is currently: \n\
-            `{self.sched_task.hours}` hours, \n\
-            `{self.sched_task.minutes}` minutes, \n\
-            `{self.sched_task.seconds}` seconds")
+            `{hrs}` hours, \n\
+            `{mins}` minutes, \n\
+            `{secs}` seconds \n\
+            Servers with players are queried every `{self.pipeline.poll_scheduler.active_interval}` seconds.")
         else:
-            self.sched_task.change_interval(seconds = secs, minutes = mins, hours = hrs)
+            self.pipeline.poll_scheduler.idle_interval = hrs * 3600 + mins * 60 + secs
             await ctx.send(f"Server query interval now set to: `{hrs}` hours, `{mins}` minutes and `{secs}` seconds.")
 
     ##################
@@ -611,6 +1382,7 @@ class Palantir(commands.Cog):
             await ctx.send("Invalid scope, use 'guild' or 'global'")
             return
 
+        import pprint
         await ctx.send(f"```\n{pprint.pformat(raw_config)}\n```")
 
     @debug.command(name = "dumpserverinfo", hidden = True)
@@ -618,16 +1390,186 @@ class Palantir(commands.Cog):
 
         """A tool to get raw server data as a text file"""
 
+        from .attachments import server_dump_payload
+
         async with ctx.typing():
-            servers = await self.scan_servers()
+            async with self.scan_lock:
+                servers, cut_off, failed = await self.pipeline.scan(await self.pipeline.refresh_master())
+
+            loop = asyncio.get_running_loop()
+            parts = await loop.run_in_executor(None, server_dump_payload,
+                [server.to_dict() for server in servers], "serveroutput.txt", self.upload_limit(ctx))
+            await self.send_parts(ctx, "Server query output", parts)
+
+    @debug.command(name = "editstats", hidden = True)
+    async def _editstats(self, ctx: commands.Context):
+
+        """Show how many embed edits were sent and how many were skipped because nothing changed"""
+
+        sent = self.metrics.counters["edits_sent"]
+        skipped = self.metrics.counters["edits_skipped"]
+        total = sent + skipped
+        saved = 100 * skipped / total if total else 0
 
-            with open("serverdata.txt", "w") as file:
-                file.write(pprint.pformat(servers))
+        await ctx.send(f"Embed edits sent: `{sent}`, skipped: `{skipped}` ({saved:.1f}% saved)")
+
+    @debug.command(name = "events", hidden = True)
+    async def _events(self, ctx: commands.Context):
+
+        """Show who is subscribed to Palantir's events and how many they have missed"""
+
+        lines = []
+        for subscription in self.events.subscriptions:
+            event_types = ", ".join(event_type.__name__ for event_type in subscription.event_types)
+            lines.append(f"{event_types:<40} queued: {len(subscription.queue):<6} dropped: {subscription.dropped}")
+
+        if len(lines) == 0:
+            await ctx.send("Nobody is subscribed.")
+            return
 
-            with open("serverdata.txt", "rb") as file:
-                await ctx.send("Server query output", file = discord.File(file, "serveroutput.txt"))
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
 
-        os.remove("serverdata.txt")
+    @debug.command(name = "record", hidden = True)
+    async def _record(self, ctx: commands.Context, mode: str = None):
+
+        """
+        Record every tick's scan results to a file that benchmarks/replay_palantir.py can play back.
+        Pass 'start' or 'stop', or nothing to see whether a recording is running.
+        """
+
+        if mode is None:
+            if self.recorder is None:
+                await ctx.send("Not recording.")
+            else:
+                await ctx.send(f"Recording to `{self.recorder.path}`, `{self.recorder.ticks}` ticks so far.")
+
+        elif mode.lower() == "start":
+            if self.recorder is not None:
+                await ctx.send(f"Already recording to `{self.recorder.path}`.")
+                return
+
+            from .recorder import TickRecorder
+
+            path = cog_data_path(self) / "recordings" / f"ticks-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.jsonl.gz"
+            self.recorder = TickRecorder(path)
+            await ctx.send(f"Recording to `{path}`.")
+
+        elif mode.lower() == "stop":
+            if self.recorder is None:
+                await ctx.send("Not recording.")
+                return
+
+            recorder, self.recorder = self.recorder, None
+            # closing waits for the writer thread to finish the file
+            await asyncio.get_running_loop().run_in_executor(None, recorder.close)
+            await ctx.send(f"Recorded `{recorder.ticks}` ticks to `{recorder.path}`.")
+
+        else:
+            await ctx.send("Invalid mode, use 'start' or 'stop'")
+
+    @debug.command(name = "profile", hidden = True)
+    async def _profile(self, ctx: commands.Context, ticks: int = 1, slow_ms: int = 100):
+
+        """
+        Profile the next few ticks that poll something and upload the report and the raw profile.
+        Also lists every time the event loop was blocked for longer than slow_ms milliseconds meanwhile.
+        """
+
+        if not self.sched_task.is_running():
+            await ctx.send("Server querying is stopped, there is nothing to profile.")
+            return
+
+        if self.tick_profiler is not None:
+            await ctx.send("A profile is already being taken.")
+            return
+
+        # cProfile and pstats are only ever needed here
+        from .profiler import TickProfiler
+
+        ticks = max(1, min(ticks, 20))
+        profiler = TickProfiler(ticks, slow_callback = slow_ms / 1000)
+
+        await ctx.send(f"Profiling the next `{ticks}` ticks...")
+
+        async with ctx.typing():
+            profiler.start()
+            self.tick_profiler = profiler
+
+            try:
+                # the slowest a tick can be is its deadline, give the scheduler plenty of slack on top
+                await asyncio.wait_for(asyncio.shield(profiler.done), ticks * (self.pipeline.poll_scheduler.active_interval + self.pipeline.tick_deadline) + 60)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.tick_profiler = None
+                profiler.stop()
+
+            if len(profiler.durations) == 0:
+                await ctx.send("No tick polled anything while profiling.")
+                return
+
+            loop = asyncio.get_running_loop()
+            report = await loop.run_in_executor(None, profiler.report)
+            raw = await loop.run_in_executor(None, profiler.raw)
+
+            files = [discord.File(io.BytesIO(report.encode()), "palantir_profile.txt"),
+                discord.File(io.BytesIO(raw), "palantir_profile.prof")]
+            await ctx.send(f"Profiled `{len(profiler.durations)}` ticks, "
+                f"event loop blocked `{len(profiler.slow_callbacks.messages)}` times", files = files)
+
+    @debug.command(name = "startup", hidden = True)
+    async def _startup(self, ctx: commands.Context):
+
+        """Show how long it took from loading the cog to the first correct embed"""
+
+        if self.first_embed_at is not None:
+            await ctx.send(f"Embeds restored from saved state after `{self.first_embed_at:.2f}s`")
+        else:
+            await ctx.send("No saved state was restored on startup")
+
+        if self.first_live_embed_at is not None:
+            await ctx.send(f"First live scan published after `{self.first_live_embed_at:.2f}s`")
+        else:
+            await ctx.send("The first live scan hasn't finished yet")
+
+    @debug.command(name = "masters", hidden = True)
+    async def _masters(self, ctx: commands.Context):
+
+        """Show the master servers and how they have been answering"""
+
+        lines = []
+
+        for master, stats in self.pipeline.master_pool.stats.items():
+            rtt = f"{stats.last_rtt * 1000:.0f}ms" if stats.last_rtt is not None else "-"
+            lines.append(f"{master:<32} ok: {stats.successes:<6} failed: {stats.failures:<6} rtt: {rtt:<8} servers: {len(stats.addresses):<5} {stats.last_error or ''!r}")
+
+        lines.append(f"Merged server list: {len(self.pipeline.serverlist)} servers")
+
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
+
+    @debug.command(name = "breakers", hidden = True)
+    async def _breakers(self, ctx: commands.Context):
+
+        """Show game servers that are failing and when they will be queried again"""
+
+        now = time.monotonic()
+        lines = []
+
+        for address, health in sorted(self.pipeline.server_health.servers.items()):
+            if health.state == ServerHealth.OPEN:
+                retry = f"retry in {max(0, health.retry_at - now):.0f}s"
+            else:
+                retry = "retrying now"
+            lines.append(f"{address:<25} {health.state:<10} failures: {health.failures:<4} {retry}  {health.last_error!r}")
+
+        if len(lines) == 0:
+            await ctx.send("All game servers are healthy.")
+            return
+
+        for page in pagify("\n".join(lines)):
+            await ctx.send(box(page))
 
     @palantir.command(name = "getlog")
     async def _get_log(self, ctx: commands.Context, mode: str = "latest"):
@@ -637,22 +1579,42 @@ class Palantir(commands.Cog):
         You can pass 'latest' or 'all' as mode, defaults to latest.
         """
 
+        from .attachments import log_archive_payload, log_file_payload
+
+        loop = asyncio.get_running_loop()
+        limit = self.upload_limit(ctx)
+
         async with ctx.typing():
-            
-            if mode.lower() == "latest":
-                with open(LOGFILE, "rb") as file:
-                    await ctx.send("Latest log file", file = discord.File(file, "palantir_verbose.log"))
-            
-            elif mode.lower() == "all":
-                log_archive = shutil.make_archive("palantir_logs", "zip", os.path.join(COG_PATH, "logs"),)
-                
-                with open(log_archive, "rb") as file:
-                    await ctx.send("All log files", file = discord.File(file, "palantir_logs.zip"))
-                
-                os.remove(log_archive)
-            
-            else:
-                await ctx.send("Invalid mode, use 'latest' or 'all'")
+
+            # reading and zipping happens on a worker thread, rotated logs can be large
+            try:
+                if mode.lower() == "latest":
+                    parts = await loop.run_in_executor(None, log_file_payload, LOGFILE, limit)
+                    await self.send_parts(ctx, "Latest log file", parts)
+
+                elif mode.lower() == "all":
+                    parts = await loop.run_in_executor(None, log_archive_payload, os.path.dirname(LOGFILE), "palantir_logs.zip", limit)
+                    await self.send_parts(ctx, "All log files", parts)
+
+                else:
+                    await ctx.send("Invalid mode, use 'latest' or 'all'")
+
+            except FileNotFoundError:
+                await ctx.send("Nothing has been logged yet.")
+
+    def upload_limit(self, ctx: commands.Context) -> int:
+        from .attachments import DEFAULT_UPLOAD_LIMIT, UPLOAD_MARGIN
+        limit = ctx.guild.filesize_limit if ctx.guild is not None else DEFAULT_UPLOAD_LIMIT
+        return limit - UPLOAD_MARGIN
+
+    async def send_parts(self, ctx: commands.Context, message, parts):
+        # one part per message, the upload limit applies to everything attached to a message together
+        if len(parts) > 1:
+            message += f" (split into {len(parts)} parts, join them with `cat`)"
+
+        for filename, data in parts:
+            await ctx.send(message, file = discord.File(io.BytesIO(data), filename))
+            message = None
 
     
     @debug.command(name = "eval", hidden = True)
@@ -660,6 +1622,9 @@ class Palantir(commands.Cog):
 
         """A tool to evaluate expressions in their running environment"""
 
+        import pprint
+        import traceback
+
         expr = " ".join(exprs)
         try:
             try:
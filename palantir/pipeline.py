@@ -0,0 +1,298 @@
+"""
+The polling pipeline the cog and the shared scanner both run: refreshing the master list, probing servers
+for what the guild filters look at, the full query of the ones that match, and when each server is due again.
+"""
+
+import asyncio
+import logging
+import time
+
+from contextlib import contextmanager
+
+from pyzandro import PyZandroException
+
+from .filters import CATEGORIES, FilterIndex
+from .queryengine import (DEFAULT_BACKOFF_BASE, DEFAULT_BACKOFF_MAX, DEFAULT_CLASSIFY_TTL, DEFAULT_CONCURRENCY, DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_MASTERS, DEFAULT_TIMEOUT, CATEGORY_FLAGS, QUERY_FLAGS, ClassificationCache, DeadlineExceeded, HealthTracker, MasterPool, QueryEngine)
+from .scheduler import (DEFAULT_ACTIVE_INTERVAL, DEFAULT_IDLE_INTERVAL, DEFAULT_MASTER_INTERVAL, DEFAULT_RESOLUTION, DEFAULT_TICK_DEADLINE,
+    PollScheduler)
+from .snapshot import ServerSnapshot, decode_text, decode_wads, gametype_name
+
+# what became of a polled server
+ANSWERED = "answered"
+CUT_OFF = "cut_off"
+STALE = "stale"
+GONE = "gone"
+
+class ScanPipeline:
+
+    """
+    Everything between the master servers and a list of snapshots, built from the external JSON.
+
+    Servers are probed for what the filters look at until they are classified, only the ones matching
+    at least one filter get the full query. A populated server whose query failed counts as stale rather
+    than gone until its circuit breaker opens, so one lost reply doesn't take it off the embeds.
+    """
+
+    def __init__(self, config: dict, logger = None, metrics = None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics
+
+        query_config = config.get('query', {})
+        self.query_engine = QueryEngine(concurrency = query_config.get('concurrency', DEFAULT_CONCURRENCY),
+            timeout = query_config.get('timeout', DEFAULT_TIMEOUT))
+        if metrics is not None:
+            self.query_engine.on_rtt = metrics.observe_rtt
+        self.classification_cache = ClassificationCache(ttl = query_config.get('classify_ttl', DEFAULT_CLASSIFY_TTL))
+        self.server_health = HealthTracker(failure_threshold = query_config.get('failure_threshold', DEFAULT_FAILURE_THRESHOLD),
+            backoff_base = query_config.get('backoff_base', DEFAULT_BACKOFF_BASE),
+            backoff_max = query_config.get('backoff_max', DEFAULT_BACKOFF_MAX))
+        self.master_pool = MasterPool(self.query_engine, config.get('masters', DEFAULT_MASTERS),
+            timeout = query_config.get('master_timeout'), on_update = self.master_list_updated)
+
+        polling_config = config.get('polling', {})
+        self.poll_scheduler = PollScheduler(active_interval = polling_config.get('active_interval', DEFAULT_ACTIVE_INTERVAL),
+            idle_interval = polling_config.get('idle_interval', DEFAULT_IDLE_INTERVAL),
+            master_interval = polling_config.get('master_interval', DEFAULT_MASTER_INTERVAL))
+        self.resolution = polling_config.get('resolution', DEFAULT_RESOLUTION)
+        self.tick_deadline = polling_config.get('tick_deadline', DEFAULT_TICK_DEADLINE)
+
+        self.serverlist = []
+        self.fail_counter = 0
+
+        self.filter_index = FilterIndex({})
+        self.probe_flags = [CATEGORY_FLAGS["pwads"]]
+
+    def close(self):
+        self.master_pool.close()
+        self.query_engine.close()
+
+    def count(self, counter, amount = 1):
+        if self.metrics is not None:
+            self.metrics.count(counter, amount)
+
+    @contextmanager
+    def timed(self, phase, timings):
+        if self.metrics is not None:
+            with self.metrics.time(phase, timings):
+                yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[phase] = time.perf_counter() - start
+
+    def set_filters(self, index: FilterIndex) -> bool:
+
+        """Scan for the filters in `index` from now on. Returns whether they differ from the previous ones."""
+
+        old_keys, new_keys = set(self.filter_index.filters), set(index.filters)
+
+        if old_keys != new_keys:
+            # cached classifications point at filters that may be gone
+            self.classification_cache.clear()
+            if not new_keys <= old_keys:
+                # servers that matched nothing before may match a new filter
+                self.poll_scheduler.poll_all()
+
+        self.filter_index = index
+        self.probe_flags = [CATEGORY_FLAGS[category] for category in CATEGORIES if category in index.categories()] or [CATEGORY_FLAGS["pwads"]]
+        return old_keys != new_keys
+
+    def prune(self, server_addresses):
+        self.classification_cache.prune(server_addresses)
+        self.server_health.prune(server_addresses)
+
+    def master_list_updated(self, server_addresses):
+        # a slower master answered after the scan was already unblocked by another one
+        self.serverlist = server_addresses
+        self.poll_scheduler.sync(server_addresses)
+
+    async def refresh_master(self) -> list:
+        try:
+            self.serverlist = await self.master_pool.query()
+            self.fail_counter = 0
+        except PyZandroException:
+            self.logger.warning("The master server did not respond. Working from cache.")
+            self.fail_counter += 1
+        except (TimeoutError, asyncio.TimeoutError):
+            self.logger.warning("Request to the master server timed out. Working from cache.")
+            self.fail_counter += 1
+
+        self.prune(self.serverlist)
+        return self.serverlist
+
+    def query_succeeded(self, address, server_info, cut_off, failed) -> bool:
+        if isinstance(server_info, DeadlineExceeded):
+            cut_off.add(address)
+            return False
+
+        self.count("queries")
+
+        if not isinstance(server_info, Exception):
+            self.server_health.record_success(address)
+            return True
+
+        self.server_health.record_failure(address, server_info)
+        failed[address] = repr(server_info)
+
+        if isinstance(server_info, PyZandroException):
+            self.count("query_errors")
+            self.logger.error(f"Game server on {address} did not respond: {server_info}")
+        elif isinstance(server_info, (TimeoutError, asyncio.TimeoutError)):
+            self.count("query_timeouts")
+            self.logger.debug(f"Game server on {address} timed out")
+        elif isinstance(server_info, ConnectionResetError):
+            self.count("query_errors")
+            self.logger.debug(f"Connection to game server on {address} was reset")
+        else:
+            self.count("query_errors")
+            self.logger.error("Exception after querying", exc_info = server_info)
+
+        return False
+
+    async def scan(self, addresses, deadline = None) -> tuple:
+
+        """
+        Returns the snapshots of the servers matching a filter, the addresses whose queries were cancelled
+        because `deadline` (an event loop time) passed before they answered, and the failed ones with their errors.
+        The filters each snapshot matched are left in the classification cache.
+        """
+
+        cut_off, failed = set(), {}
+
+        if len(self.filter_index.filters) == 0:
+            # nothing to look for
+            return [], cut_off, failed
+
+        # stage one: only probe what the filters need from servers that haven't been classified yet
+        servers_to_probe = []
+        matching_addresses = []
+
+        for address in addresses:
+            # servers that keep failing are left alone until their backoff runs out
+            if not self.server_health.should_query(address):
+                continue
+
+            matches = self.classification_cache.get(address)
+            if matches is None:
+                servers_to_probe.append(address)
+            elif matches:
+                matching_addresses.append(address)
+
+        probe_results = await self.query_engine.query_servers(servers_to_probe, self.probe_flags, deadline = deadline)
+
+        for address, server_info in probe_results.items():
+            if not self.query_succeeded(address, server_info, cut_off, failed):
+                continue
+
+            matches = self.filter_index.classify(name = server_info.get('name_nocolor'),
+                iwad = decode_text(server_info.get('iwad')),
+                gametype = gametype_name(server_info.get('gametype')),
+                wads = decode_wads(server_info.get('pwads', [])))
+            self.classification_cache.set(address, matches)
+            if matches:
+                matching_addresses.append(address)
+
+        # stage two: full query, only for servers matching at least one filter
+        results = await self.query_engine.query_servers(matching_addresses, QUERY_FLAGS, deadline = deadline)
+        snapshots = []
+
+        for address, server_info in results.items():
+            if not self.query_succeeded(address, server_info, cut_off, failed):
+                continue
+
+            # the full reply carries everything the filters look at, so the classification is refreshed for free
+            snapshot = ServerSnapshot.from_query(address, server_info)
+            matches = self.filter_index.classify_snapshot(snapshot)
+            self.classification_cache.set(address, matches)
+            if matches:
+                snapshots.append(snapshot)
+
+        if len(cut_off) > 0:
+            self.count("query_cut_off", len(cut_off))
+            self.logger.warning(f"Tick deadline passed, {len(cut_off)} servers did not get to answer")
+
+        return snapshots, cut_off, failed
+
+    def settle(self, polled, snapshots, cut_off, failed, known: dict, reschedule = True) -> dict:
+
+        """
+        Decides what became of every polled address, given the snapshots `known` from before: ANSWERED, CUT_OFF,
+        STALE (populated, failed, breaker still closed) or GONE. Also puts each back on the schedule unless
+        `reschedule` is False, for ticks polled elsewhere.
+        """
+
+        results = {snapshot.address: snapshot for snapshot in snapshots}
+        outcomes = {}
+
+        for address in polled:
+            snapshot = results.get(address)
+            previous = known.get(address)
+
+            if snapshot is not None:
+                outcomes[address] = ANSWERED
+                if reschedule:
+                    self.poll_scheduler.reschedule(address, active = snapshot.humans > 0)
+            elif address in cut_off:
+                # the server never got its chance to answer, it is asked again right away
+                outcomes[address] = CUT_OFF
+                if reschedule:
+                    self.poll_scheduler.retry(address)
+            elif address in failed and previous is not None and previous.humans > 0 and self.server_health.failing(address):
+                outcomes[address] = STALE
+                if reschedule:
+                    self.poll_scheduler.reschedule(address, active = True)
+            else:
+                outcomes[address] = GONE
+                if reschedule:
+                    self.poll_scheduler.reschedule(address, active = False)
+
+        return outcomes
+
+    async def poll(self, known: dict, deadline = None):
+
+        """
+        Refresh the master list if it is due and scan whatever servers are due. Returns None if nothing was,
+        a PollResult otherwise. `known` holds the last snapshot of every server listed so far.
+        """
+
+        timings = {}
+        serverlist = None
+
+        if self.poll_scheduler.master_due():
+            with self.timed("master", timings):
+                serverlist = await self.refresh_master()
+            self.poll_scheduler.sync(serverlist)
+            self.poll_scheduler.master_refreshed()
+
+        due_servers = self.poll_scheduler.pop_due()
+        if serverlist is None and len(due_servers) == 0:
+            return None
+
+        snapshots, cut_off, failed = [], set(), {}
+        if len(due_servers) > 0:
+            with self.timed("scan", timings):
+                snapshots, cut_off, failed = await self.scan(due_servers, deadline = deadline)
+
+        outcomes = self.settle(due_servers, snapshots, cut_off, failed, known)
+        return PollResult(serverlist, due_servers, snapshots, cut_off, failed, outcomes, timings)
+
+
+
+class PollResult:
+
+    """What one poll saw. `serverlist` is None unless the master list was refreshed."""
+
+    __slots__ = ("serverlist", "polled", "snapshots", "cut_off", "failed", "outcomes", "timings")
+
+    def __init__(self, serverlist, polled, snapshots, cut_off, failed, outcomes, timings):
+        self.serverlist = serverlist
+        self.polled = polled
+        self.snapshots = snapshots
+        self.cut_off = cut_off
+        self.failed = failed
+        self.outcomes = outcomes
+        self.timings = timings
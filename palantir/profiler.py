@@ -0,0 +1,124 @@
+import asyncio
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import time
+
+from contextlib import contextmanager
+
+DEFAULT_SLOW_CALLBACK = 0.1
+REPORT_ENTRIES = 30
+
+class SlowCallbackHandler(logging.Handler):
+
+    """Collects asyncio's debug mode warnings about callbacks that held the event loop too long"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Executing "):
+            self.messages.append(message)
+
+
+
+class TickProfiler:
+
+    """
+    Runs cProfile over the next `ticks` scheduled ticks that polled something.
+
+    While it is active the event loop is put in debug mode, so every callback or coroutine step
+    taking longer than `slow_callback` seconds gets reported. Both are undone once the last tick is in.
+    Only the event loop thread is profiled, the time queries spend on worker threads shows up as waiting.
+    """
+
+    def __init__(self, ticks, slow_callback = DEFAULT_SLOW_CALLBACK):
+        self.ticks = ticks
+        self.slow_callback = slow_callback
+
+        self.profile = cProfile.Profile()
+        self.durations = []
+        self.slow_callbacks = SlowCallbackHandler()
+        self.done = asyncio.get_running_loop().create_future()
+
+        self.loop = None
+        self.previous_debug = None
+        self.previous_slow_callback = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.previous_debug = self.loop.get_debug()
+        self.previous_slow_callback = self.loop.slow_callback_duration
+
+        self.loop.slow_callback_duration = self.slow_callback
+        self.loop.set_debug(True)
+        logging.getLogger("asyncio").addHandler(self.slow_callbacks)
+
+    def stop(self):
+        if self.loop is None:
+            return
+
+        self.loop.set_debug(self.previous_debug)
+        self.loop.slow_callback_duration = self.previous_slow_callback
+        logging.getLogger("asyncio").removeHandler(self.slow_callbacks)
+        self.loop = None
+
+        if not self.done.done():
+            self.done.set_result(None)
+
+    @contextmanager
+    def profile_tick(self):
+
+        """Profile the tick run inside, set `.counts = False` on the returned object to not count it"""
+
+        tick = TickResult()
+        start = time.perf_counter()
+        self.profile.enable()
+        try:
+            yield tick
+        finally:
+            self.profile.disable()
+            if tick.counts:
+                self.durations.append(time.perf_counter() - start)
+                if len(self.durations) >= self.ticks:
+                    self.stop()
+
+    def report(self) -> str:
+        out = io.StringIO()
+
+        out.write(f"Profiled {len(self.durations)} ticks: {', '.join(f'{d * 1000:.0f} ms' for d in self.durations)}\n\n")
+
+        out.write(f"Event loop blocked for more than {self.slow_callback * 1000:.0f} ms: {len(self.slow_callbacks.messages)} times\n")
+        for message in self.slow_callbacks.messages:
+            out.write(f"    {message}\n")
+
+        stats = pstats.Stats(self.profile, stream = out)
+        stats.strip_dirs()
+
+        out.write("\n\n=== By own time ===\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(REPORT_ENTRIES)
+
+        out.write("\n=== By cumulative time ===\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_ENTRIES)
+
+        return out.getvalue()
+
+    def raw(self) -> bytes:
+
+        """The profile in the format of cProfile's dump_stats, for pstats, snakeviz and the like"""
+
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)
+
+
+
+class TickResult:
+
+    __slots__ = ("counts",)
+
+    def __init__(self):
+        self.counts = True
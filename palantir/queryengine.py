@@ -0,0 +1,330 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyzandro
+from pyzandro.server import SQF
+
+DEFAULT_CONCURRENCY = 32
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_CLASSIFY_TTL = 3600
+DEFAULT_FAILURE_THRESHOLD = 2
+DEFAULT_BACKOFF_BASE = 60
+DEFAULT_BACKOFF_MAX = 3600
+DEFAULT_MASTERS = ['master.qzandronum.com:15300', 'master.zandronum.com:15300']
+
+# everything the snapshots, the embeds and the guild filters need from a game server
+QUERY_FLAGS = [SQF.NAME, SQF.MAPNAME, SQF.NUMPLAYERS, SQF.PLAYERDATA, SQF.GAMETYPE, SQF.IWAD, SQF.PWADS, SQF.FORCEPASSWORD, SQF.FORCEJOINPASSWORD]
+
+# what the cheap classification probe has to ask for, depending on what the guild filters look at
+CATEGORY_FLAGS = {"pwads": SQF.PWADS, "iwads": SQF.IWAD, "gametypes": SQF.GAMETYPE, "names": SQF.NAME}
+
+class DeadlineExceeded(Exception):
+
+    """Stands in for the result of a query that was cancelled because the tick ran out of time"""
+
+    pass
+
+
+class QueryEngine:
+
+    """
+    Runs pyzandro queries concurrently without blocking the event loop.
+
+    pyzandro only exposes blocking calls, so every query is handed to a bounded
+    worker pool and awaited with a per-server deadline. A full scan therefore
+    takes about as long as the slowest responsive server instead of the sum of all.
+
+    `backend` is anything with pyzandro's query_master and query_server, the benchmarks swap in a local fake.
+    `on_rtt`, when set, is called with the round trip of every answered game server query.
+    """
+
+    def __init__(self, concurrency = DEFAULT_CONCURRENCY, timeout = DEFAULT_TIMEOUT, backend = pyzandro):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.backend = backend
+        self.on_rtt = None
+
+        self.executor = ThreadPoolExecutor(max_workers = concurrency, thread_name_prefix = "palantir-query")
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def _run(self, timeout, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+
+        # the slot is held until the worker thread is actually done, not until we stop waiting for it,
+        # otherwise timed out queries would pile up in the executor queue and eat the deadline of the next ones
+        await self.semaphore.acquire()
+        future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        future.add_done_callback(self._finished)
+
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+    def _finished(self, future):
+        self.semaphore.release()
+        # nobody may be waiting for the result anymore, retrieve the error so asyncio doesn't complain about it
+        if not future.cancelled():
+            future.exception()
+
+    async def query_master(self, address, timeout = None) -> list:
+        return await self._run(timeout or self.timeout, self.backend.query_master, address)
+
+    @staticmethod
+    def _timed(func, *args, **kwargs):
+        # timed on the worker thread, so waiting for a free worker doesn't count towards the round trip
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    async def query_server(self, address, flags) -> dict:
+        server_info, rtt = await self._run(self.timeout, self._timed, self.backend.query_server, address, flags = flags)
+        if self.on_rtt is not None:
+            self.on_rtt(rtt)
+
+        server_info['address'] = address
+        return server_info
+
+    async def query_servers(self, addresses, flags, deadline = None) -> dict:
+
+        """
+        Query every address at once. Returns a dict of address -> server info,
+        or the exception raised for that address.
+
+        `deadline` is an event loop time. Queries still running when it passes are cancelled
+        and come back as DeadlineExceeded, everything that did answer is returned as usual.
+        """
+
+        tasks = {address: asyncio.ensure_future(self.query_server(address, flags)) for address in addresses}
+        if len(tasks) == 0:
+            return {}
+
+        timeout = None if deadline is None else max(0, deadline - asyncio.get_running_loop().time())
+        done, pending = await asyncio.wait(tasks.values(), timeout = timeout)
+
+        for task in pending:
+            task.cancel()
+        # the worker threads finish on their own, only the waiting is given up on
+        await asyncio.gather(*pending, return_exceptions = True)
+
+        results = {}
+        for address, task in tasks.items():
+            if task in pending:
+                results[address] = DeadlineExceeded(f"{address} was cut off by the tick deadline")
+            elif task.exception() is not None:
+                results[address] = task.exception()
+            else:
+                results[address] = task.result()
+
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait = False)
+
+
+
+class ClassificationCache:
+
+    """
+    Remembers which guild filters a server address matched, so servers
+    known not to match any are only probed again once their entry expires.
+    """
+
+    def __init__(self, ttl = DEFAULT_CLASSIFY_TTL):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, address):
+
+        """Returns the matched filters of a known address (empty if none), None if it has to be probed."""
+
+        entry = self.entries.get(address)
+        if entry is None:
+            return None
+
+        matches, expires = entry
+        if expires < time.monotonic():
+            del self.entries[address]
+            return None
+
+        return matches
+
+    def set(self, address, matches):
+        self.entries[address] = (matches, time.monotonic() + self.ttl)
+
+    def clear(self):
+        self.entries.clear()
+
+    def prune(self, addresses):
+
+        """Drop entries of servers that are no longer on the master list."""
+
+        known = set(addresses)
+        for address in [a for a in self.entries if a not in known]:
+            del self.entries[address]
+
+
+
+class ServerHealth:
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        self.state = ServerHealth.CLOSED
+        self.failures = 0
+        self.retry_at = 0
+        self.last_error = None
+
+
+
+class HealthTracker:
+
+    """
+    Per-server circuit breaker.
+
+    After `failure_threshold` consecutive failures a server is skipped for an exponentially
+    growing backoff capped at `backoff_max` seconds. Once the backoff runs out the server is
+    half-open: it gets one query, success closes the breaker, failure opens it again for longer.
+    """
+
+    def __init__(self, failure_threshold = DEFAULT_FAILURE_THRESHOLD, backoff_base = DEFAULT_BACKOFF_BASE, backoff_max = DEFAULT_BACKOFF_MAX):
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.servers = {}
+
+    def should_query(self, address) -> bool:
+        health = self.servers.get(address)
+        if health is None or health.state != ServerHealth.OPEN:
+            return True
+
+        if time.monotonic() >= health.retry_at:
+            health.state = ServerHealth.HALF_OPEN
+            return True
+
+        return False
+
+    def failing(self, address) -> bool:
+
+        """Whether the last query of a server failed, but not often enough yet to open its breaker"""
+
+        health = self.servers.get(address)
+        return health is not None and health.state == ServerHealth.CLOSED
+
+    def record_success(self, address):
+        self.servers.pop(address, None)
+
+    def record_failure(self, address, error):
+        health = self.servers.setdefault(address, ServerHealth())
+        health.failures += 1
+        health.last_error = error
+
+        if health.failures >= self.failure_threshold:
+            backoff = min(self.backoff_base * 2 ** (health.failures - self.failure_threshold), self.backoff_max)
+            health.state = ServerHealth.OPEN
+            health.retry_at = time.monotonic() + backoff
+
+    def prune(self, addresses):
+        known = set(addresses)
+        for address in [a for a in self.servers if a not in known]:
+            del self.servers[address]
+
+
+
+class MasterStats:
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.last_rtt = None
+        self.last_error = None
+        self.addresses = []
+
+
+
+class MasterPool:
+
+    """
+    Queries several master servers at once and merges their server lists.
+
+    The first master to answer unblocks `query()`, the others keep running in the background
+    and `on_update` is called with the merged list whenever one of them answers late.
+    A master that stops answering keeps contributing its last known list.
+    """
+
+    def __init__(self, engine: QueryEngine, masters, timeout = None, on_update = None):
+        self.engine = engine
+        self.masters = list(masters)
+        self.timeout = timeout
+        self.on_update = on_update
+
+        self.stats = {master: MasterStats() for master in self.masters}
+        self.pending = {}
+        self.querying = False
+
+    def merged(self) -> list:
+        # a dict keeps the order the masters are configured in while dropping duplicates
+        addresses = {}
+        for master in self.masters:
+            for address in self.stats[master].addresses:
+                addresses[address] = None
+        return list(addresses)
+
+    async def _query(self, master) -> list:
+        stats = self.stats[master]
+        start = time.monotonic()
+
+        try:
+            addresses = await self.engine.query_master(master, timeout = self.timeout)
+        except Exception as e:
+            stats.failures += 1
+            stats.last_error = e
+            raise
+
+        stats.successes += 1
+        stats.last_rtt = time.monotonic() - start
+        stats.last_error = None
+        stats.addresses = list(addresses)
+        return addresses
+
+    def _done(self, master, task):
+        del self.pending[master]
+
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        if not self.querying and self.on_update is not None:
+            self.on_update(self.merged())
+
+    async def query(self) -> list:
+
+        """Returns the merged server list as soon as one master answers, raises the last error if none does."""
+
+        for master in self.masters:
+            # a master still busy with the previous refresh is not asked again
+            if master not in self.pending:
+                task = asyncio.ensure_future(self._query(master))
+                task.add_done_callback(functools.partial(self._done, master))
+                self.pending[master] = task
+
+        waiting = set(self.pending.values())
+        last_error = None
+
+        self.querying = True
+        try:
+            while len(waiting) > 0:
+                done, waiting = await asyncio.wait(waiting, return_when = asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return self.merged()
+                    last_error = task.exception()
+        finally:
+            self.querying = False
+
+        raise last_error
+
+    def close(self):
+        for task in self.pending.values():
+            task.cancel()
@@ -0,0 +1,108 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .snapshot import ServerSnapshot
+
+RECORDING_VERSION = 1
+
+def open_recording(path, mode):
+    # recordings ending in .gz are compressed, appending to one just adds another gzip member
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding = "utf-8")
+    return open(path, mode, encoding = "utf-8")
+
+
+
+class TickRecorder:
+
+    """
+    Appends what every tick saw to a line-delimited JSON file, one line per tick:
+    the master list if it was refreshed, the polled addresses, the snapshots of the servers that answered,
+    the ones cut off by the tick deadline, the ones that failed, the master's failure count and how long
+    the master query and the scan took.
+
+    Serializing and writing happens on a worker thread of its own, lines are written in tick order.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "palantir-recorder")
+        self.file = None
+        self.ticks = 0
+
+    def _append(self, record):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            self.file = open_recording(self.path, "a")
+
+        self.file.write(json.dumps(record, separators = (',', ':'), default = str) + "\n")
+        self.file.flush()
+
+    def record(self, timings, serverlist, polled, servers, cut_off, failed = None, master_failures = None, ts = None):
+        self.ticks += 1
+        self.executor.submit(self._append, {
+            "version": RECORDING_VERSION,
+            "ts": ts or time.time(),
+            "timings": timings,
+            "serverlist": serverlist,
+            "polled": list(polled),
+            "servers": [server.to_dict() for server in servers],
+            "cut_off": sorted(cut_off),
+            "failed": failed or {},
+            "master_failures": master_failures,
+        })
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.executor.submit(self._close)
+        self.executor.shutdown(wait = True)
+
+def read_recording(path):
+
+    """Yields the ticks of a recording in order, with the servers turned back into snapshots"""
+
+    with open_recording(path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("version") != RECORDING_VERSION:
+                continue
+            record["servers"] = [ServerSnapshot.from_dict(server) for server in record["servers"]]
+            yield record
+
+async def replay_recording(cog, records, speed = 1.0, on_tick = None):
+
+    """
+    Feed recorded ticks through the cog as if they had just been scanned: the activity check,
+    rendering and the embed edits all run for real, only the queries are skipped.
+
+    `speed` 1.0 keeps the recorded pace, 2.0 is twice as fast and None goes as fast as possible.
+    `on_tick(record, seconds)` is called with the time each tick took to publish.
+    """
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    first_ts = None
+
+    for record in records:
+        if first_ts is None:
+            first_ts = record["ts"]
+
+        if speed is not None:
+            await asyncio.sleep(max(0, started + (record["ts"] - first_ts) / speed - loop.time()))
+
+        tick_start = time.perf_counter()
+
+        # classified against the replaying cog's filters, not the ones the recording was made with
+        cog.apply_recorded_tick(record)
+        await cog.publish_state()
+
+        if on_tick is not None:
+            on_tick(record, time.perf_counter() - tick_start)
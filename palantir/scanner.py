@@ -0,0 +1,311 @@
+"""
+A scanner process that several bots can share.
+
+It polls the master and the game servers on the same schedule the cog uses and publishes what it
+sees over a Unix socket, so running Palantir on several Red instances doesn't multiply the queries.
+Cogs with `scanner.socket` set in config.json subscribe to it instead of scanning themselves,
+and go back to scanning in-process whenever it can't be reached.
+
+    python -m palantir.scanner --socket /run/palantir/scanner.sock
+
+The protocol is one JSON object per line. Subscribers send `{"filters": [...]}` with the keys of their
+guild filters when they connect and whenever those change, the scanner probes and classifies servers
+against all of them together and only fully queries the ones matching at least one.
+The scanner sends lines in the same shape as a tick recording (see recorder.py): a new subscriber first
+gets the full current state, then one line per tick.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from collections import deque
+
+from .filters import FilterIndex
+from .pipeline import ANSWERED, GONE, ScanPipeline
+from .recorder import RECORDING_VERSION
+from .snapshot import ServerSnapshot
+
+DEFAULT_RETRY_INTERVAL = 30
+
+# a scanner started by a cog outlives it, and exits once no cog has been subscribed for this long
+DEFAULT_IDLE_EXIT = 300
+
+# a subscriber this far behind is cut off, it gets the full state again when it reconnects
+MAX_CLIENT_BUFFER = 16 * 1024 * 1024
+MAX_PENDING_TICKS = 100
+MAX_LINE = 256 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+def encode_tick(serverlist, polled, servers, cut_off, timings = None, failed = None, master_failures = 0) -> bytes:
+    return (json.dumps({
+        "version": RECORDING_VERSION,
+        "ts": time.time(),
+        "timings": timings or {},
+        "serverlist": serverlist,
+        "polled": list(polled),
+        "servers": [server.to_dict() for server in servers],
+        "cut_off": sorted(cut_off),
+        "failed": failed or {},
+        "master_failures": master_failures,
+    }, separators = (',', ':'), default = str) + "\n").encode()
+
+
+
+class ScanService:
+
+    """
+    Scans the servers on the master list for all subscribers at once and publishes the snapshots.
+
+    Servers are probed and classified against every subscriber's guild filters together, and only the ones
+    matching at least one of them get the full query. Each subscriber then applies its own filters to what it gets.
+    """
+
+    def __init__(self, socket_path, config: dict, backend = None, idle_exit = 0):
+        self.socket_path = socket_path
+        self.idle_exit = idle_exit
+
+        self.pipeline = ScanPipeline(config, logger = logger)
+        if backend is not None:
+            self.pipeline.query_engine.backend = backend
+
+        self.servers = {}
+        self.clients = set()
+        self.server = None
+        self.idle_since = time.monotonic()
+
+        self.client_filters = {}
+
+    def broadcast(self, line: bytes):
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                logger.warning("Dropping a subscriber that stopped reading")
+                self.clients.discard(writer)
+                writer.close()
+                continue
+            writer.write(line)
+
+    def update_filters(self):
+        keys = set()
+        for client_keys in self.client_filters.values():
+            keys |= client_keys
+
+        guild_filters = {}
+        for key in keys:
+            try:
+                guild_filter = json.loads(key)
+            except ValueError:
+                continue
+            if isinstance(guild_filter, dict):
+                guild_filters[key] = guild_filter
+
+        index = FilterIndex(guild_filters)
+        if not self.pipeline.set_filters(index):
+            return
+
+        self.servers = {address: server for address, server in self.servers.items() if index.classify_snapshot(server)}
+        logger.info(f"Scanning for {len(index.filters)} distinct filters")
+
+    async def handle_client(self, reader, writer):
+        # only what the scanner has snapshots of counts as polled, the subscriber keeps listing everything else
+        # it knows until the scanner's own ticks get to it
+        writer.write(encode_tick(self.pipeline.serverlist, list(self.servers), list(self.servers.values()), (),
+            master_failures = self.pipeline.fail_counter))
+        self.clients.add(writer)
+        logger.info(f"Subscriber connected, {len(self.clients)} in total")
+
+        try:
+            # subscribers only ever send their filters, again whenever those change
+            async for line in reader:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(message, dict) and isinstance(message.get("filters"), list):
+                    self.client_filters[writer] = {key for key in message["filters"] if isinstance(key, str)}
+                    self.update_filters()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            if self.client_filters.pop(writer, None) is not None:
+                self.update_filters()
+            writer.close()
+            logger.info(f"Subscriber disconnected, {len(self.clients)} left")
+
+    async def tick(self):
+        deadline = asyncio.get_running_loop().time() + self.pipeline.tick_deadline
+        result = await self.pipeline.poll(self.servers, deadline = deadline)
+        if result is None:
+            return
+
+        if result.serverlist is not None:
+            known = set(result.serverlist)
+            for address in [a for a in self.servers if a not in known]:
+                del self.servers[address]
+
+        results = {snapshot.address: snapshot for snapshot in result.snapshots}
+        for address, outcome in result.outcomes.items():
+            if outcome == ANSWERED:
+                self.servers[address] = results[address]
+            elif outcome == GONE:
+                self.servers.pop(address, None)
+
+        self.broadcast(encode_tick(result.serverlist, result.polled, result.snapshots, result.cut_off, result.timings, result.failed,
+            self.pipeline.fail_counter))
+
+    async def start(self):
+        if os.path.exists(self.socket_path):
+            try:
+                _, writer = await asyncio.open_unix_connection(self.socket_path)
+                writer.close()
+                raise RuntimeError(f"A scanner is already running on {self.socket_path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                # left behind by a scanner that didn't shut down cleanly
+                os.unlink(self.socket_path)
+
+        self.server = await asyncio.start_unix_server(self.handle_client, self.socket_path)
+        logger.info(f"Scanner listening on {self.socket_path}")
+
+    async def run(self):
+        await self.start()
+        try:
+            while True:
+                start = time.monotonic()
+
+                if len(self.clients) > 0:
+                    self.idle_since = None
+                elif self.idle_since is None:
+                    self.idle_since = start
+                elif self.idle_exit and start - self.idle_since >= self.idle_exit:
+                    logger.info(f"No subscribers for {self.idle_exit:.0f} seconds, exiting")
+                    return
+
+                try:
+                    await self.tick()
+                except Exception:
+                    logger.exception("Scanner tick failed")
+                await asyncio.sleep(max(0, self.pipeline.resolution - (time.monotonic() - start)))
+        finally:
+            self.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        for writer in self.clients:
+            writer.close()
+        self.pipeline.close()
+
+
+
+class ScannerClient:
+
+    """
+    A cog's subscription to a scanner. Ticks received in the background are collected until
+    the cog's own scheduled task picks them up with drain().
+    """
+
+    def __init__(self, socket_path, retry_interval = DEFAULT_RETRY_INTERVAL):
+        self.socket_path = socket_path
+        self.retry_interval = retry_interval
+
+        self.records = deque()
+        self.reader_task = None
+        self.writer = None
+        self.next_attempt = 0
+        self.filters = []
+
+    @property
+    def connected(self) -> bool:
+        return self.reader_task is not None and not self.reader_task.done()
+
+    async def ensure_connected(self) -> bool:
+
+        """Connects if not connected, but only tries every `retry_interval` seconds"""
+
+        if self.connected:
+            return True
+        if time.monotonic() < self.next_attempt:
+            return False
+        self.next_attempt = time.monotonic() + self.retry_interval
+
+        try:
+            reader, self.writer = await asyncio.open_unix_connection(self.socket_path, limit = MAX_LINE)
+        except OSError:
+            return False
+
+        self.records.clear()
+        self.reader_task = asyncio.ensure_future(self._read(reader))
+        self._send_filters()
+        return True
+
+    def send_filters(self, filter_keys):
+
+        """Tells the scanner which guild filters to scan for, now and every time it reconnects"""
+
+        self.filters = sorted(filter_keys)
+        if self.connected:
+            self._send_filters()
+
+    def _send_filters(self):
+        self.writer.write((json.dumps({"filters": self.filters}) + "\n").encode())
+
+    async def _read(self, reader):
+        try:
+            async for line in reader:
+                record = json.loads(line)
+                if record.get("version") != RECORDING_VERSION:
+                    continue
+                record["servers"] = [ServerSnapshot.from_dict(server) for server in record["servers"]]
+                self.records.append(record)
+
+                if len(self.records) > MAX_PENDING_TICKS:
+                    # nobody is picking them up, reconnecting later brings the full state back
+                    self.records.clear()
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.writer.close()
+
+    def drain(self) -> list:
+        records = list(self.records)
+        self.records.clear()
+        return records
+
+    def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Scan Zandronum servers once for every Palantir cog on this machine")
+    parser.add_argument("--socket", required = True, help = "path of the Unix socket to publish on")
+    parser.add_argument("--config", default = os.path.join(os.path.dirname(__file__), "config.json"),
+        help = "Palantir's config.json, for the master servers and polling settings")
+    parser.add_argument("--idle-exit", type = float, default = 0,
+        help = "exit once no cog has been subscribed for this many seconds, 0 keeps running")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(name)s: [%(levelname)s] %(message)s", datefmt = "%Y-%m-%d %H:%M:%S")
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+
+    try:
+        asyncio.run(ScanService(args.socket, config, idle_exit = args.idle_exit).run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import heapq
+import time
+
+DEFAULT_RESOLUTION = 10
+DEFAULT_ACTIVE_INTERVAL = 30
+DEFAULT_IDLE_INTERVAL = 240
+DEFAULT_MASTER_INTERVAL = 300
+DEFAULT_TICK_DEADLINE = 15
+
+class PollScheduler:
+
+    """
+    Keeps every known game server on a priority queue ordered by when it is due to be polled next.
+
+    Servers with players on them are polled every `active_interval` seconds, everything else
+    every `idle_interval` seconds. Addresses that show up on the master list for the first time
+    are due right away. The master list itself is refreshed every `master_interval` seconds.
+    """
+
+    def __init__(self, active_interval = DEFAULT_ACTIVE_INTERVAL, idle_interval = DEFAULT_IDLE_INTERVAL, master_interval = DEFAULT_MASTER_INTERVAL):
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.master_interval = master_interval
+
+        self.queue = []
+        self.due_at = {}
+        self.master_due_at = 0
+
+    def master_due(self) -> bool:
+        return time.monotonic() >= self.master_due_at
+
+    def master_refreshed(self):
+        self.master_due_at = time.monotonic() + self.master_interval
+
+    def sync(self, addresses):
+
+        """Start tracking new addresses and forget the ones that left the master list."""
+
+        now = time.monotonic()
+        addresses = set(addresses)
+
+        for address in addresses:
+            if address not in self.due_at:
+                self.schedule(address, now)
+
+        for address in [a for a in self.due_at if a not in addresses]:
+            # the queue entry is left behind and skipped when it comes up
+            del self.due_at[address]
+
+    def schedule(self, address, due):
+        self.due_at[address] = due
+        heapq.heappush(self.queue, (due, address))
+
+    def reschedule(self, address, active: bool):
+        if address not in self.due_at:
+            return
+
+        interval = self.active_interval if active else self.idle_interval
+        self.schedule(address, time.monotonic() + min(interval, self.idle_interval))
+
+    def retry(self, address):
+
+        """Make a server due again right away, for polls that were cut short."""
+
+        if address in self.due_at:
+            self.schedule(address, time.monotonic())
+
+    def pop_due(self) -> list:
+        now = time.monotonic()
+        due_servers = []
+
+        while len(self.queue) > 0 and self.queue[0][0] <= now:
+            due, address = heapq.heappop(self.queue)
+            if self.due_at.get(address) == due:
+                due_servers.append(address)
+                # fallback in case the poll never gets to reschedule it
+                self.schedule(address, now + self.idle_interval)
+
+        return due_servers
+
+    def poll_all(self):
+
+        """Make every known server due right away."""
+
+        now = time.monotonic()
+        for address in list(self.due_at):
+            self.schedule(address, now)
@@ -0,0 +1,115 @@
+GAMETYPES = ["cooperative", "survival", "invasion", "deathmatch", "teamplay", "duel", "terminator", "lastmanstanding",
+    "teamlms", "possession", "teampossession", "teamgame", "ctf", "oneflagctf", "skulltag", "domination"]
+
+def decode_wads(pwads) -> tuple:
+    return tuple(str(wad_bytes, 'utf-8', 'replace') for wad_bytes in pwads)
+
+def decode_text(value) -> str:
+    if isinstance(value, bytes):
+        return str(value, 'utf-8', 'replace')
+    return value or ""
+
+def gametype_name(gametype) -> str:
+
+    """Turn whatever the game mode came back as into a lowercase name like 'ctf'"""
+
+    if isinstance(gametype, dict):
+        gametype = gametype.get('gamemode', gametype.get('gametype'))
+    if isinstance(gametype, int) and 0 <= gametype < len(GAMETYPES):
+        return GAMETYPES[gametype]
+    if gametype is None:
+        return ""
+    return str(getattr(gametype, 'name', gametype)).lower()
+
+
+
+class PlayerSnapshot:
+
+    __slots__ = ("name", "is_bot")
+
+    def __init__(self, name, is_bot: bool):
+        self.name = name
+        self.is_bot = is_bot
+
+    @classmethod
+    def from_query(cls, player_info):
+        return cls(player_info['name_nocolor'], player_info['bot'] == 1)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data['bot'])
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "bot": self.is_bot}
+
+    def __repr__(self):
+        return f"PlayerSnapshot({self.name!r}, is_bot = {self.is_bot})"
+
+
+
+class ServerSnapshot:
+
+    """
+    The state of a game server as of one query.
+
+    Everything the activity check and the embed need is derived once when the reply comes in,
+    including `fingerprint`, which only changes when something visible in the embed does.
+    """
+
+    __slots__ = ("address", "name", "mapname", "gametype", "iwad", "num_players", "players", "wads", "locked", "humans", "fingerprint")
+
+    def __init__(self, address, name, mapname, gametype, iwad, num_players, players, wads, locked):
+        self.address = address
+        self.name = name
+        self.mapname = mapname
+        self.gametype = gametype
+        self.iwad = iwad
+        self.num_players = num_players
+        self.players = tuple(players)
+        self.wads = tuple(wads)
+        self.locked = locked
+
+        self.humans = num_players - sum(1 for player in self.players if player.is_bot)
+        self.fingerprint = (address, name, mapname, num_players, locked,
+            tuple(sorted((player.name, player.is_bot) for player in self.players)))
+
+    @classmethod
+    def from_query(cls, address, server_info):
+        return cls(address = address,
+            name = server_info['name_nocolor'],
+            mapname = server_info['mapname'],
+            gametype = gametype_name(server_info.get('gametype')),
+            iwad = decode_text(server_info.get('iwad')),
+            num_players = server_info['num_players'],
+            players = [PlayerSnapshot.from_query(player) for player in server_info['players']],
+            wads = decode_wads(server_info['pwads']),
+            locked = server_info['forcepassword'] == True or server_info['forcejoinpassword'] == True)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(address = data['address'],
+            name = data['name'],
+            mapname = data['mapname'],
+            gametype = data['gametype'],
+            iwad = data.get('iwad', ""),
+            num_players = data['num_players'],
+            players = [PlayerSnapshot.from_dict(player) for player in data['players']],
+            wads = data['wads'],
+            locked = data['locked'])
+
+    def to_dict(self) -> dict:
+        return {
+            "address": self.address,
+            "name": self.name,
+            "mapname": self.mapname,
+            "gametype": self.gametype,
+            "iwad": self.iwad,
+            "num_players": self.num_players,
+            "humans": self.humans,
+            "locked": self.locked,
+            "wads": list(self.wads),
+            "players": [player.to_dict() for player in self.players],
+        }
+
+    def __repr__(self):
+        return f"ServerSnapshot({self.address!r}, {self.name!r}, humans = {self.humans})"
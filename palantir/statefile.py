@@ -0,0 +1,44 @@
+import json
+import os
+
+from .snapshot import ServerSnapshot
+
+STATE_VERSION = 1
+
+def save_state(path, serverlist, servers, active_servers):
+
+    """
+    Write the last master list, server snapshots and activity state to `path`.
+    The file is written next to the old one and moved in place, so a crash never leaves half a file behind.
+    """
+
+    state = {
+        "version": STATE_VERSION,
+        "serverlist": list(serverlist),
+        "servers": [server.to_dict() for server in servers],
+        "active_servers": sorted(active_servers),
+    }
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, separators = (',', ':'), default = str)
+    os.replace(tmp_path, path)
+
+def load_state(path):
+
+    """Returns (serverlist, servers, active_servers) from `path`, or None if there is no usable state file."""
+
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if state.get("version") != STATE_VERSION:
+        return None
+
+    try:
+        servers = [ServerSnapshot.from_dict(server) for server in state["servers"]]
+        return state["serverlist"], servers, set(state["active_servers"])
+    except (KeyError, TypeError):
+        return None
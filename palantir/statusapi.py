@@ -0,0 +1,62 @@
+import hashlib
+import json
+
+from aiohttp import web
+
+class StatusDocument:
+
+    """
+    The latest server list, serialized once whenever it changes.
+
+    Requests only ever get the stored bytes, so answering them costs no JSON encoding and no game server queries.
+    """
+
+    def __init__(self):
+        self.update({"updated": None, "master_available": True, "servers": []})
+
+    def update(self, payload: dict):
+        self.body = json.dumps(payload, separators = (",", ":")).encode()
+        self.etag = f'"{hashlib.blake2b(self.body, digest_size = 8).hexdigest()}"'
+
+    def matches(self, if_none_match) -> bool:
+        if if_none_match is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # weak validators compare equal too, nothing here depends on byte identity
+        tags = {tag.strip() for tag in if_none_match.split(",")}
+        return self.etag in tags or f"W/{self.etag}" in tags
+
+
+
+class StatusServer:
+
+    """Serves a StatusDocument read-only on http://host:port/status"""
+
+    def __init__(self, document: StatusDocument, host, port):
+        self.document = document
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle_status(self, request):
+        document = self.document
+        headers = {"ETag": document.etag, "Cache-Control": "no-cache"}
+
+        if document.matches(request.headers.get("If-None-Match")):
+            return web.Response(status = 304, headers = headers)
+
+        return web.Response(body = document.body, content_type = "application/json", headers = headers)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/status", self.handle_status)
+
+        self.runner = web.AppRunner(app, access_log = None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None